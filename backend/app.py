@@ -1,37 +1,84 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
 from validateRequest import validate_json_request
 from dotenv import load_dotenv
 from requestSchemas import RequestSchemas
 from databaseManager import DatabaseManager, PresetManager
+from historyEncoding import HISTORY_MIMETYPE, pack_history
+from requestMetrics import init_metrics, metrics_response
+import os
 import sqlite3
+import threading
 import time
+import json
+from functools import wraps
 
 app = Flask(__name__)
 load_dotenv()
 app.config.from_prefixed_env()
 app.cli.add_command(DatabaseManager.init_db)
+app.cli.add_command(DatabaseManager.migrate_db)
 app.cli.add_command(DatabaseManager.populate_db)
+app.cli.add_command(DatabaseManager.apply_retention)
+init_metrics(app)
 
 @app.teardown_appcontext
 def teardown_db(e=None):
     DatabaseManager.close_db()
 
+@app.after_request
+def add_sql_timing(response):
+    # Shows the time spent in sqlite in the browser's network panel
+    trace = DatabaseManager.get_sql_trace()
+    if trace is not None:
+        response.headers.add(
+            'Server-Timing', 
+            f'db;dur={trace.elapsed * 1000:.1f};desc="{trace.statements} statements"'
+        )
+    return response
+
+def versioned(name):
+    # Tags successful responses with the version of the data they depend on,
+    # answering with 304 before running the view if the client is up to date
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = f"{name}-{DatabaseManager.get_version(name)}"
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return metrics_response()
+
 @app.route("/get/presets/atomic", methods=["GET"])
+@versioned("presets")
 def get_presets_atomic():
     presets = PresetManager.get_atomic_presets()
     return jsonify(presets)
 
 @app.route("/get/presets/day", methods=["GET"])
+@versioned("presets")
 def get_presets_day():
     presets = PresetManager.get_day_presets()
     return jsonify(presets)
 
 @app.route("/get/presets/week", methods=["GET"])
+@versioned("presets")
 def get_presets_week():
     presets = PresetManager.get_week_presets()
     return jsonify(presets)
 
 @app.route("/get/presets/combination", methods=["GET"])
+@versioned("presets")
 def get_presets_combination():
     combination = request.args.get('combination', type=int)
     if (not combination) or (combination < 1 or combination > 7):
@@ -56,41 +103,85 @@ def get_presets_combination():
 
 
 
+def get_at():
+    # Optional ?at=<timestamp> to read the presets as they were at that time
+    if 'at' not in request.args:
+        return None, None
+    at = request.args.get('at', type=int)
+    if at is None or at < 0:
+        return None, "Invalid at"
+    return at, None
+
 @app.route("/get/preset/atomic", methods=["GET"])
+@versioned("presets")
 def get_preset_atomic():
     id = request.args.get('id', type=int)
     if (not id) or (id < 1):
         return "Invalid id", 400
+    at, error_message = get_at()
+    if error_message is not None:
+        return error_message, 400
 
     try:
-        preset = PresetManager.get_atomic_preset(id)
+        preset = PresetManager.get_atomic_preset(id, at)
         return jsonify(preset)
+    except KeyError as e:
+        return str(e.args[0]), 404
     except Exception as e:
-        return f"Encountered error {e}"
+        return f"Encountered error {e}", 500
 
 @app.route("/get/preset/day", methods=["GET"])
+@versioned("presets")
 def get_preset_day():
     id = request.args.get('id', type=int)
     if (not id) or (id < 1):
         return "Invalid id", 400
+    at, error_message = get_at()
+    if error_message is not None:
+        return error_message, 400
 
     try:
-        preset = PresetManager.get_day_preset(id)
+        preset = PresetManager.get_day_preset(id, at)
         return jsonify(preset)
+    except KeyError as e:
+        return str(e.args[0]), 404
     except Exception as e:
-        return f"Encountered error {e}"
+        return f"Encountered error {e}", 500
 
 @app.route("/get/preset/week", methods=["GET"])
+@versioned("presets")
 def get_preset_week():
     id = request.args.get('id', type=int)
     if (not id) or (id < 1):
         return "Invalid id", 400
+    at, error_message = get_at()
+    if error_message is not None:
+        return error_message, 400
 
     try:
-        preset = PresetManager.get_week_preset(id)
+        preset = PresetManager.get_week_preset(id, at)
         return jsonify(preset)
+    except KeyError as e:
+        return str(e.args[0]), 404
     except Exception as e:
-        return f"Encountered error {e}"
+        return f"Encountered error {e}", 500
+
+@app.route("/get/presets/details", methods=["GET"])
+@versioned("presets")
+def get_preset_details():
+    # ?id=1&id=2, with &resolve=1 to include every preset they refer to
+    ids = request.args.getlist('id', type=int)
+    if len(ids) == 0 or any(id < 1 for id in ids):
+        return "Invalid id", 400
+    resolve_children = request.args.get('resolve', default=0, type=int) == 1
+
+    try:
+        presets = PresetManager.get_preset_details(ids, resolve_children)
+        return jsonify(presets)
+    except KeyError as e:
+        return str(e.args[0]), 404
+    except Exception as e:
+        return f"Encountered error {e}", 500
 
 
 
@@ -98,8 +189,13 @@ def get_preset_week():
 
 
 @app.route("/get/config", methods=["GET"])
+@versioned("preset_history")
 def get_config():
-    presets = PresetManager.get_active()
+    at, error_message = get_at()
+    if error_message is not None:
+        return error_message, 400
+
+    presets = PresetManager.get_active(at)
     return jsonify(presets)
 
 @app.route("/set/config", methods=["POST"])
@@ -185,6 +281,32 @@ def edit_preset_week():
 
 
 
+@app.route("/export/presets", methods=["GET"])
+@versioned("presets")
+def export_presets():
+    presets = PresetManager.export_presets()
+    return jsonify(presets)
+
+@app.route("/import/presets", methods=["POST"])
+def import_presets():
+    document, error_message = validate_json_request(RequestSchemas.presetImport.import_, request)
+    if document is None:
+        return error_message, 400
+
+    error_message = PresetManager.check_preset_import(document)
+    if error_message is not None:
+        return error_message, 400
+
+    try:
+        ids = PresetManager.import_presets(document)
+        return jsonify({'ids': ids}), 201
+    except sqlite3.Error as e:
+        return f"Transaction Failed {e}", 500
+
+
+
+
+
 @app.route("/get/history", methods=["GET"])
 def get_history_day():
     durationMap = {
@@ -200,5 +322,92 @@ def get_history_day():
     duration = durationMap[duration]
     now = int(time.time())
 
-    history = PresetManager.get_history(now-duration, now)
-    return jsonify(history)
\ No newline at end of file
+    mimetype = request.accept_mimetypes.best_match(['application/json', HISTORY_MIMETYPE])
+    if mimetype == HISTORY_MIMETYPE:
+        history = PresetManager.get_history(now-duration, now, columnar=True)
+        response = make_response(pack_history(history))
+        response.mimetype = HISTORY_MIMETYPE
+    elif request.args.get('stream', default=0, type=int) == 1:
+        # Written out as the readings are read, for memory constrained hosts
+        history = PresetManager.stream_history(now-duration, now)
+        response = Response(stream_with_context(history), mimetype='application/json')
+    else:
+        columnar = request.args.get('format', type=str) == 'columnar'
+        history = PresetManager.get_history(now-duration, now, columnar=columnar)
+        response = jsonify(history)
+
+    response.vary.add('Accept')
+    return response
+
+
+
+
+
+# Seconds between checks for new readings, and between keepalive comments
+# that stop proxies closing an idle stream
+STREAM_POLL_INTERVAL = 1
+STREAM_KEEPALIVE_INTERVAL = 15
+# Streams allowed open at once in each worker. Each holds one of the
+# worker's threads, so this should leave some free for other requests
+STREAM_SLOTS = threading.BoundedSemaphore(int(os.environ.get('MAX_STREAMS', 8)))
+STREAM_RETRY_AFTER = 30
+
+def stream_event(event, data, id=None):
+    message = f"event: {event}\ndata: {json.dumps(data)}\n"
+    if id is not None:
+        message = f"id: {id}\n{message}"
+    return message + "\n"
+
+@app.route("/stream/temperatures", methods=["GET"])
+def stream_temperatures():
+    # Readings are sent with their time as the event id, so a reconnecting
+    # client picks up from the last one it received
+    after = request.headers.get('Last-Event-ID', type=int)
+
+    if not STREAM_SLOTS.acquire(blocking=False):
+        response = make_response("Too many open streams", 503)
+        response.headers['Retry-After'] = STREAM_RETRY_AFTER
+        return response
+
+    def generate():
+        nonlocal after
+        if after is None:
+            after = PresetManager.get_latest_temperature_time()
+        data_version = None
+        relay_state = None
+        last_sent = time.monotonic()
+
+        while True:
+            # Only query again once the controller has committed something
+            version = DatabaseManager.get_data_version()
+            if version != data_version:
+                data_version = version
+                events = []
+
+                for reading in PresetManager.get_temperatures_after(after):
+                    events.append(stream_event('temperature', reading, id=reading['time']))
+                    after = reading['time']
+
+                state = PresetManager.get_relay_state()
+                if state is not None and state != relay_state:
+                    events.append(stream_event('relay', state))
+                    relay_state = state
+
+                DatabaseManager.get_db().rollback()
+                if len(events) > 0:
+                    yield "".join(events)
+                    last_sent = time.monotonic()
+
+            if time.monotonic() - last_sent >= STREAM_KEEPALIVE_INTERVAL:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+
+            time.sleep(STREAM_POLL_INTERVAL)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    # Called once the client disconnects, or if the stream never starts
+    response.call_on_close(STREAM_SLOTS.release)
+    response.cache_control.no_cache = True
+    # Stops nginx buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -2,31 +2,129 @@ import sqlite3
 from flask import current_app, g
 import click
 import time
-from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-import random
+import json
+import threading
+import os
+from scheduleResolver import ChunkVersions, LocalDays, ScheduleResolver, compile_schedule, truncate_timeline
+from temperatureRetention import RetentionPolicy, apply_retention
+from syntheticData import DatasetSpec, generate_dataset, max_versions
+from sqlTrace import SqlTracer, RequestTrace, TracedConnection
 
 class DatabaseManager():
     tz = ZoneInfo("Europe/London")
-    db_name = "/app/data/temperatures_and_presets.db"
+    db_name = os.environ.get('DB_NAME', "/app/data/temperatures_and_presets.db")
+
+    # Seconds sqlite waits on a lock held by the controller before giving up
+    busy_timeout = 5
+    # Times a transaction is retried if it still couldn't get the lock
+    lock_retries = 3
+    lock_backoff = 0.1
+    # Number of lock waits seen by this worker
+    lock_waits = 0
+    # Set up on the first connection if SQL_TRACE=1, see sqlTrace.py
+    sql_tracer = None
+    sql_tracer_loaded = False
+
+    # Each thread keeps its connection between requests, so the schema is
+    # parsed and the fixed queries are compiled once rather than per request
+    _local = threading.local()
+    # Compiled statements kept per connection, enough for every fixed query
+    cached_statements = 256
+    # Page cache per connection in KiB, and bytes of the file to memory map
+    cache_size = 4096
+    mmap_size = 64 * 1024 * 1024
+
+    @staticmethod
+    def _connect():
+        tracer = DatabaseManager.get_sql_tracer()
+        con = sqlite3.connect(
+            DatabaseManager.db_name,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=DatabaseManager.busy_timeout,
+            cached_statements=DatabaseManager.cached_statements,
+            autocommit=True,
+            factory=sqlite3.Connection if tracer is None else TracedConnection
+        )
+        # Traced cursors need a trace to count into, even for the setup
+        # below. get_db gives each request a fresh one
+        if tracer is not None:
+            con.trace = RequestTrace(tracer)
+        # WAL lets the controller write while history is being read, but
+        # can only be enabled outside of a transaction
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute(f"PRAGMA cache_size=-{int(DatabaseManager.cache_size)};")
+        con.execute(f"PRAGMA mmap_size={int(DatabaseManager.mmap_size)};")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.autocommit = False
+        con.row_factory = sqlite3.Row
+        return con
 
     @staticmethod
     def get_db():
         if 'db' not in g:
-            g.db = sqlite3.connect(
-                DatabaseManager.db_name,
-                detect_types=sqlite3.PARSE_DECLTYPES,
-                autocommit=False
-            )
-            g.db.row_factory = sqlite3.Row
+            local = DatabaseManager._local
+            if getattr(local, 'db_name', None) != DatabaseManager.db_name:
+                if getattr(local, 'con', None) is not None:
+                    local.con.close()
+                local.con = DatabaseManager._connect()
+                local.db_name = DatabaseManager.db_name
+
+            g.db = local.con
+            if DatabaseManager.get_sql_tracer() is not None:
+                g.db.trace = RequestTrace(DatabaseManager.sql_tracer)
         return g.db
 
+    @staticmethod
+    def is_locked(e):
+        return (
+            isinstance(e, sqlite3.OperationalError)
+            and (e.sqlite_errorcode & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+        )
+
+    @staticmethod
+    def _record_lock_wait(attempt):
+        DatabaseManager.lock_waits += 1
+        current_app.logger.warning(
+            f"Database locked, retrying transaction ({DatabaseManager.lock_waits} lock waits)"
+        )
+        time.sleep(DatabaseManager.lock_backoff * (2 ** attempt))
+
+    @staticmethod
+    def get_sql_tracer():
+        if not DatabaseManager.sql_tracer_loaded:
+            DatabaseManager.sql_tracer = SqlTracer.from_env(os.environ, current_app.logger)
+            DatabaseManager.sql_tracer_loaded = True
+        return DatabaseManager.sql_tracer
+
+    @staticmethod
+    def get_sql_trace():
+        # Statements run so far by this request, or None when not tracing
+        if 'db' not in g:
+            return None
+        return getattr(g.db, 'trace', None)
+
     @staticmethod
     def close_db():
+        # Returns the connection to this thread rather than closing it
         db = g.pop('db', None)
 
         if db is not None:
-            db.close()
+            trace = getattr(db, 'trace', None)
+            if trace is not None:
+                trace.finish()
+                current_app.logger.info(
+                    f"Ran {trace.statements} statements in {trace.elapsed * 1000:.1f}ms, {trace.slow} slow"
+                )
+            try:
+                # Ends the request's read transaction, so the connection
+                # doesn't hold an old snapshot or block checkpoints while idle
+                db.rollback()
+            except sqlite3.Error:
+                db.close()
+                DatabaseManager._local.con = None
+                DatabaseManager._local.db_name = None
     
     @staticmethod
     def query_db(query, args={}, one=False):
@@ -40,6 +138,22 @@ class DatabaseManager():
         finally:
             cur.close()
     
+    @staticmethod
+    def iterate_db(query, args={}, size=1000):
+        # Yields rows as they are read, so a large result is never held in
+        # memory all at once
+        con = DatabaseManager.get_db()
+        try:
+            cur = con.cursor()
+            cur.execute(query, args)
+            while True:
+                rows = cur.fetchmany(size)
+                if len(rows) == 0:
+                    return
+                yield from rows
+        finally:
+            cur.close()
+
     @staticmethod
     def querymany_db(query, args=[], one=False):
         con = DatabaseManager.get_db()
@@ -56,21 +170,43 @@ class DatabaseManager():
         finally:
             cur.close()
 
+    @staticmethod
+    def get_version(name):
+        result = DatabaseManager.query_db(
+            "SELECT version FROM data_versions WHERE name = :name;",
+            args={'name': name},
+            one=True
+        )
+        return result['version']
+
+    @staticmethod
+    def get_data_version():
+        # Changes whenever another connection commits to the database. Reading
+        # it opens a read transaction, which is ended straight away so that the
+        # next call sees any newer commits
+        con = DatabaseManager.get_db()
+        try:
+            return con.execute("PRAGMA data_version;").fetchone()[0]
+        finally:
+            con.rollback()
+
     @staticmethod
     def execute_db(cur_func):
         def innerFunc(*args, **kwargs):
             con = DatabaseManager.get_db()
-            result = None
-            try:
-                cur = con.cursor()
-                result = cur_func(cur, *args, **kwargs)
-                con.commit()
-            except sqlite3.Error as e:
-                con.rollback()
-                raise e
-            finally:
-                cur.close()
-            return result
+            for attempt in range(DatabaseManager.lock_retries + 1):
+                try:
+                    cur = con.cursor()
+                    result = cur_func(cur, *args, **kwargs)
+                    con.commit()
+                    return result
+                except sqlite3.Error as e:
+                    con.rollback()
+                    if not DatabaseManager.is_locked(e) or attempt == DatabaseManager.lock_retries:
+                        raise e
+                    DatabaseManager._record_lock_wait(attempt)
+                finally:
+                    cur.close()
         return innerFunc
     
     @staticmethod
@@ -79,57 +215,385 @@ class DatabaseManager():
     def init_db(cur):
         with current_app.open_resource('schema.sql') as f:
             cur.executescript(f.read().decode('utf8'))
-            print("Initialised database")
+        for version, name in DatabaseManager._get_migrations(0):
+            DatabaseManager._apply_migration(cur, version, name)
+        print("Initialised database")
+
+    @staticmethod
+    def _get_migrations(current_version):
+        # Migrations are named <version>_<description>.sql
+        migrations = []
+        for name in os.listdir(os.path.join(current_app.root_path, 'migrations')):
+            if name.endswith('.sql'):
+                version = int(name.split('_', 1)[0])
+                if version > current_version:
+                    migrations.append((version, name))
+        return sorted(migrations)
+
+    @staticmethod
+    def _apply_migration(cur, version, name):
+        with current_app.open_resource(os.path.join('migrations', name)) as f:
+            cur.executescript(f.read().decode('utf8'))
+        # Can't be bound as a parameter, but version is always an int
+        cur.execute(f"PRAGMA user_version = {int(version)};")
+        print(f"Applied migration {name}")
+
+    @staticmethod
+    @click.command("migrate-db")
+    def migrate_db():
+        version = DatabaseManager.query_db("PRAGMA user_version;", one=True)[0]
+        migrations = DatabaseManager._get_migrations(version)
+        if len(migrations) == 0:
+            print(f"Database is up to date at version {version}")
+        
+        # Each migration is its own transaction, so a failure leaves the
+        # database at the last version which succeeded
+        apply_migration = DatabaseManager.execute_db(DatabaseManager._apply_migration)
+        for version, name in migrations:
+            apply_migration(version, name)
     
+    @staticmethod
+    @click.command("apply-retention")
+    @click.option("--raw-days", type=int, help="Days of full resolution readings to keep")
+    @click.option("--rollup-days", type=int, help="Days of 5 minute rollups to keep")
+    @click.option("--batch-size", type=int, help="Rows removed per transaction")
+    @click.option("--archive", type=click.Path(dir_okay=False), help="Database file to move removed readings to")
+    def apply_retention(raw_days, rollup_days, batch_size, archive):
+        policy = RetentionPolicy.from_env(os.environ)
+        if raw_days is not None:
+            policy.raw_days = raw_days
+        if rollup_days is not None:
+            policy.rollup_days = rollup_days
+        if batch_size is not None:
+            policy.batch_size = batch_size
+        if archive is not None:
+            policy.archive = archive
+
+        removed = apply_retention(
+            DatabaseManager.db_name, 
+            policy, 
+            busy_timeout=DatabaseManager.busy_timeout
+        )
+        print(f"Removed {removed['raw']} readings and {removed['rollup']} rollups")
+
     @staticmethod
     @click.command("populate-db")
-    @execute_db
-    def populate_db(cur):
+    @click.option("--days", type=int, default=7, show_default=True, help="Days of readings, ending now")
+    @click.option("--end", type=int, help="Unix time to end at instead of now")
+    @click.option("--atomic-presets", type=int, default=0, show_default=True, help="Number of atomic presets")
+    @click.option("--day-presets", type=int, default=0, show_default=True, help="Number of day presets")
+    @click.option("--week-presets", type=int, default=0, show_default=True, help="Number of week presets")
+    @click.option("--versions", type=int, default=1, show_default=True, help="Versions of each preset, spread over the range")
+    @click.option("--activation-hours", type=float, default=0, show_default=True, help="Mean hours between activations, 0 for none")
+    @click.option("--chunk-size", type=int, default=7 * 24 * 60, show_default=True, help="Rows written per transaction")
+    @click.option("--seed", type=int, help="Seed for repeatable data")
+    def populate_db(days, end, atomic_presets, day_presets, week_presets, versions, activation_hours, chunk_size, seed):
+        if (day_presets > 0 or week_presets > 0) and atomic_presets == 0:
+            raise click.UsageError("Day and week presets need at least one atomic preset")
+        if days < 1 or versions < 1 or chunk_size < 1:
+            raise click.UsageError("--days, --versions and --chunk-size must be at least 1")
+        if versions > max_versions(days):
+            raise click.UsageError(f"--versions can be at most {max_versions(days)} for {days} days")
+
+        spec = DatasetSpec(
+            days=days,
+            atomic_presets=atomic_presets,
+            day_presets=day_presets,
+            week_presets=week_presets,
+            versions=versions,
+            activation_hours=activation_hours,
+            chunk_size=chunk_size,
+            seed=seed
+        )
+        if end is None:
+            end = int(time.time())
+
         print("Generating data")
-        core = 450
-        difference = 0
-        records = []
-        now = int(time.time())
-        core_change = 0
-        difference_change = 0
-        for i in range(7 * 24 * 60, -1, -1):
-            core = max(min(core + core_change, 500), 300)
-            difference = max(min(difference + difference_change, 100), -5)
-            core_change = max(min(core_change + random.randint(-1,1), 10), -10)
-            difference_change = max(min(difference_change + random.randint(-1,1), 10), -10)
-            records.append({
-                'time': now - (i * 60),
-                'core': core,
-                'oven': core - difference,
-                'core_on': core_change > 0,
-                'oven_on': core_change - difference_change > 0
-            })
-        print("Inserting data")
-        cur.executemany("""
-            INSERT INTO temperatures 
-                (time, core, oven, core_on, oven_on) 
-            VALUES 
-                (:time, :core, :oven, :core_on, :oven_on)
-        """, records)
-        print("Finished")
+        counts = generate_dataset(DatabaseManager.get_db(), spec, end)
+        print(f"Inserted {counts['presets']} presets, {counts['activations']} activations and {counts['readings']} readings")
         
 
+class PresetCatalogue():
+    # Current definition of every preset, shared by all requests in this 
+    # worker. Reloaded whenever the presets version in data_versions changes, 
+    # which also catches writes made by other workers
+    _lock = threading.Lock()
+    _version = None
+    _presets = {}
+
+    @staticmethod
+    def invalidate():
+        with PresetCatalogue._lock:
+            PresetCatalogue._version = None
+
+    @staticmethod
+    def _format_atomic(row, name):
+        return {
+            'id': row['preset_id'],
+            'name': name,
+            'temperature': {
+                'core': {
+                    'high': row['core_high'],
+                    'low': row['core_low']
+                },
+                'oven': {
+                    'high': row['oven_high'],
+                    'low': row['oven_low']
+                }
+            }
+        }
+
+    @staticmethod
+    def _format_day(id, name, chunks):
+        # Chunks must be in order of start
+        return {
+            'id': id,
+            'name': name,
+            'preset': [row['chunk_preset_id'] for row in chunks],
+            'time': [
+                {
+                    'hour': row['start'] // (60 * 60), 
+                    'minute': (row['start'] // 60) % 60
+                }
+                for row in chunks if row['start'] > 0
+            ]
+        }
+
+    @staticmethod
+    def _format_week(row, name):
+        return {
+            'id': row['preset_id'],
+            'name': name,
+            'preset': [
+                row['monday_preset_id'],
+                row['tuesday_preset_id'],
+                row['wednesday_preset_id'],
+                row['thursday_preset_id'],
+                row['friday_preset_id'],
+                row['saturday_preset_id'],
+                row['sunday_preset_id']
+            ]
+        }
+
+    @staticmethod
+    def _load():
+        names = DatabaseManager.query_db("""
+            SELECT preset_id, name
+            FROM preset_names
+            WHERE valid_to IS NULL;
+        """)
+        names = {row['preset_id']: row['name'] for row in names}
+
+        presets = {}
+
+        atomic_presets = DatabaseManager.query_db("""
+            SELECT preset_id, core_high, core_low, oven_high, oven_low
+            FROM atomic_presets
+            WHERE valid_to IS NULL;
+        """)
+
+        for row in atomic_presets:
+            presets[row['preset_id']] = ('atomic', PresetCatalogue._format_atomic(row, names[row['preset_id']]))
+
+        day_preset_chunks = DatabaseManager.query_db("""
+            SELECT preset_id, start, chunk_preset_id
+            FROM day_preset_chunks
+            WHERE valid_to IS NULL
+            ORDER BY preset_id ASC, start ASC;
+        """)
+
+        chunks = {}
+        for row in day_preset_chunks:
+            chunks.setdefault(row['preset_id'], []).append(row)
+
+        for id, rows in chunks.items():
+            presets[id] = ('day', PresetCatalogue._format_day(id, names[id], rows))
+
+        week_presets = DatabaseManager.query_db("""
+            SELECT preset_id, monday_preset_id, tuesday_preset_id, wednesday_preset_id, thursday_preset_id, friday_preset_id, saturday_preset_id, sunday_preset_id
+            FROM week_presets
+            WHERE valid_to IS NULL;
+        """)
+
+        for row in week_presets:
+            presets[row['preset_id']] = ('week', PresetCatalogue._format_week(row, names[row['preset_id']]))
+
+        return dict(sorted(presets.items()))
+
+    @staticmethod
+    def get_all():
+        version = DatabaseManager.get_version('presets')
+        with PresetCatalogue._lock:
+            if version != PresetCatalogue._version:
+                PresetCatalogue._presets = PresetCatalogue._load()
+                PresetCatalogue._version = version
+            return PresetCatalogue._presets
+
+    @staticmethod
+    def get_presets(preset_type):
+        return [
+            {'id': preset['id'], 'name': preset['name']} 
+            for _type, preset in PresetCatalogue.get_all().values()
+            if _type == preset_type
+        ]
+
+    @staticmethod
+    def get_preset(preset_type, id):
+        _type, preset = PresetCatalogue.get_all().get(id, (None, None))
+        if _type != preset_type:
+            raise KeyError(f"No {preset_type} preset with id {id}")
+        return preset
+
+    @staticmethod
+    def get_preset_details(ids, resolve_children=False):
+        # Requested presets, grouped by type, along with every preset they
+        # refer to if resolve_children is set
+        presets = PresetCatalogue.get_all()
+        details = {'atomic': [], 'day': [], 'week': []}
+        for id in ids:
+            if id not in presets:
+                raise KeyError(f"No preset with id {id}")
+
+        seen = {0}
+        pending = list(ids)
+        while len(pending) > 0:
+            id = pending.pop()
+            if id in seen or id not in presets:
+                continue
+            seen.add(id)
+
+            preset_type, preset = presets[id]
+            details[preset_type].append(preset)
+            if resolve_children and preset_type != 'atomic':
+                pending.extend(preset['preset'])
+
+        for preset_type in details:
+            details[preset_type].sort(key=lambda preset: preset['id'])
+        return details
+
+    @staticmethod
+    def _query_version_at(table, columns, id, at):
+        # Versions of a preset don't overlap, so the one valid at a time is
+        # the latest starting at or before it, found with a seek on the
+        # primary key however many versions there are
+        return DatabaseManager.query_db(f"""
+            SELECT {columns}
+            FROM {table}
+            WHERE 
+                preset_id = :id
+                AND valid_from = (
+                    SELECT max(valid_from)
+                    FROM {table}
+                    WHERE preset_id = :id AND valid_from <= :at
+                )
+                AND (valid_to IS NULL OR valid_to > :at);
+        """, args={'id': id, 'at': at}, one=True)
+
+    @staticmethod
+    def _query_day_chunks_at(id, at):
+        # Chunks are versioned separately, but always cover the whole day,
+        # so each chunk valid at a time is found by a seek on the primary
+        # key from where the previous one ended
+        return DatabaseManager.query_db("""
+            WITH RECURSIVE chunks (start, end, chunk_preset_id) AS (
+                SELECT NULL, 0, NULL
+                UNION ALL
+                SELECT d.start, d.end, d.chunk_preset_id
+                FROM chunks as c
+                INNER JOIN day_preset_chunks as d
+                ON 
+                    d.preset_id = :id
+                    AND d.start = c.end
+                    AND d.valid_from = (
+                        SELECT max(valid_from)
+                        FROM day_preset_chunks
+                        WHERE preset_id = :id AND start = c.end AND valid_from <= :at
+                    )
+                    AND (d.valid_to IS NULL OR d.valid_to > :at)
+                WHERE c.end < 86400
+            )
+            SELECT start, chunk_preset_id
+            FROM chunks
+            WHERE start IS NOT NULL
+            ORDER BY start ASC;
+        """, args={'id': id, 'at': at})
+
+    @staticmethod
+    def get_preset_at(preset_type, id, at):
+        # As get_preset, but read from the versions valid at the given time
+        # instead of the cache
+        row = DatabaseManager.query_db(
+            "SELECT type FROM preset_ids WHERE id = :id;",
+            args={'id': id},
+            one=True
+        )
+        name = None
+        if row is not None and row['type'] == preset_type:
+            name = PresetCatalogue._query_version_at('preset_names', 'name', id, at)
+        # The name and the definition are versioned separately, so either
+        # can be missing at the given time
+        missing = KeyError(f"No {preset_type} preset with id {id} at {at}")
+        if name is None:
+            raise missing
+        name = name['name']
+
+        if preset_type == 'atomic':
+            row = PresetCatalogue._query_version_at(
+                'atomic_presets', 'preset_id, core_high, core_low, oven_high, oven_low', id, at)
+            if row is None:
+                raise missing
+            return PresetCatalogue._format_atomic(row, name)
+
+        if preset_type == 'day':
+            chunks = PresetCatalogue._query_day_chunks_at(id, at)
+            if len(chunks) == 0:
+                raise missing
+            return PresetCatalogue._format_day(id, name, chunks)
+
+        row = PresetCatalogue._query_version_at(
+            'week_presets', 'preset_id, monday_preset_id, tuesday_preset_id, wednesday_preset_id, thursday_preset_id, friday_preset_id, saturday_preset_id, sunday_preset_id', id, at)
+        if row is None:
+            raise missing
+        return PresetCatalogue._format_week(row, name)
+
 class PresetManager():
+    # How far ahead of a write the limit timeline is resolved
+    timeline_horizon = 7 * 24 * 60 * 60
+
+    # Compiled schedule of the active preset, shared by requests in this worker
+    schedule_resolver = ScheduleResolver(DatabaseManager.tz)
+
+    # Seconds between readings written by the controller
+    temperature_interval = 60
+
+    # Tables of aggregated readings, keyed by the size of their buckets
+    rollup_tables = {
+        5 * 60: 'temperatures_5m',
+        60 * 60: 'temperatures_1h'
+    }
+
+    # History uses the finest resolution giving at most this many readings
+    max_history_points = 1000
+
+    # Readings written per piece of a streamed history
+    history_chunk_rows = 500
+
     @staticmethod
-    def _init_preset(cur):
-        cur.execute("INSERT INTO preset_ids DEFAULT VALUES;")
+    def _init_preset(cur, preset_type):
+        cur.execute("INSERT INTO preset_ids (type) VALUES (:type);", {'type': preset_type})
         return cur.lastrowid
 
     @staticmethod
-    def _insert_preset_name(cur, id, preset):
-        cur.execute(
+    def _insert_preset_names(cur, presets):
+        PresetCatalogue.invalidate()
+        cur.executemany(
             """
                 INSERT INTO preset_names 
                     (preset_id, name) 
                 VALUES 
                     (:preset_id, :name)
             """, 
-            {**preset, 'preset_id': id}
+            [{**preset, 'preset_id': id} for id, preset in presets]
         )
 
     
@@ -201,23 +665,26 @@ class PresetManager():
 
 
     
+    # Each takes a list of (id, preset) pairs, so that a whole import can be
+    # written with one executemany per table
+
     @staticmethod
-    def _insert_atomic_preset(cur, id, preset):
-        PresetManager._insert_preset_name(cur, id, preset)
-        cur.execute(
+    def _insert_atomic_presets(cur, presets):
+        PresetManager._insert_preset_names(cur, presets)
+        cur.executemany(
             """
                 INSERT INTO atomic_presets 
                     (preset_id, core_high, core_low, oven_high, oven_low) 
                 VALUES 
                     (:preset_id, :core_high, :core_low, :oven_high, :oven_low)
             """, 
-            {**preset, 'preset_id': id}
+            [{**preset, 'preset_id': id} for id, preset in presets]
         )
 
     @staticmethod
-    def _insert_day_preset(cur, id, preset):
-        PresetManager._insert_preset_name(cur, id, preset)
-        chunks = ({**p, 'preset_id': id} for p in preset['chunks'])
+    def _insert_day_presets(cur, presets):
+        PresetManager._insert_preset_names(cur, presets)
+        chunks = ({**p, 'preset_id': id} for id, preset in presets for p in preset['chunks'])
         cur.executemany(
             """
                 INSERT INTO day_preset_chunks 
@@ -229,16 +696,16 @@ class PresetManager():
         )
     
     @staticmethod
-    def _insert_week_preset(cur, id, preset):
-        PresetManager._insert_preset_name(cur, id, preset)
-        cur.execute(
+    def _insert_week_presets(cur, presets):
+        PresetManager._insert_preset_names(cur, presets)
+        cur.executemany(
             """
                 INSERT INTO week_presets 
                     (preset_id, monday_preset_id, tuesday_preset_id, wednesday_preset_id, thursday_preset_id, friday_preset_id, saturday_preset_id, sunday_preset_id) 
                 VALUES 
                     (:preset_id, :monday_preset_id, :tuesday_preset_id, :wednesday_preset_id, :thursday_preset_id, :friday_preset_id, :saturday_preset_id, :sunday_preset_id)
             """, 
-            {**preset, 'preset_id': id}
+            [{**preset, 'preset_id': id} for id, preset in presets]
         )
 
 
@@ -248,22 +715,22 @@ class PresetManager():
     @staticmethod
     @DatabaseManager.execute_db
     def create_atomic_preset(cur, preset):
-        id = PresetManager._init_preset(cur)
-        PresetManager._insert_atomic_preset(cur, id, preset)
+        id = PresetManager._init_preset(cur, 'atomic')
+        PresetManager._insert_atomic_presets(cur, [(id, preset)])
         return id
     
     @staticmethod
     @DatabaseManager.execute_db
     def create_day_preset(cur, preset):
-        id = PresetManager._init_preset(cur)
-        PresetManager._insert_day_preset(cur, id, preset)
+        id = PresetManager._init_preset(cur, 'day')
+        PresetManager._insert_day_presets(cur, [(id, preset)])
         return id
     
     @staticmethod
     @DatabaseManager.execute_db
     def create_week_preset(cur, preset):
-        id = PresetManager._init_preset(cur)
-        PresetManager._insert_week_preset(cur, id, preset)
+        id = PresetManager._init_preset(cur, 'week')
+        PresetManager._insert_week_presets(cur, [(id, preset)])
         return id
 
 
@@ -273,181 +740,142 @@ class PresetManager():
     @staticmethod
     @DatabaseManager.execute_db
     def update_atomic_preset(cur, id, preset):
-        PresetManager._insert_atomic_preset(cur, id, preset)
+        now = PresetManager._get_now(cur)
+        PresetManager._insert_atomic_presets(cur, [(id, preset)])
+        PresetManager._refresh_timeline(cur, now)
 
     @staticmethod
     @DatabaseManager.execute_db
     def update_day_preset(cur, id, preset):
-        PresetManager._insert_day_preset(cur, id, preset)
+        now = PresetManager._get_now(cur)
+        PresetManager._insert_day_presets(cur, [(id, preset)])
+        PresetManager._refresh_timeline(cur, now)
 
     @staticmethod
     @DatabaseManager.execute_db
     def update_week_preset(cur, id, preset):
-        PresetManager._insert_week_preset(cur, id, preset)
+        now = PresetManager._get_now(cur)
+        PresetManager._insert_week_presets(cur, [(id, preset)])
+        PresetManager._refresh_timeline(cur, now)
 
 
 
 
     @staticmethod
-    def get_atomic_presets():
-        query = """
-            SELECT p.preset_id, p.name 
-            FROM preset_names as p
-            INNER JOIN atomic_presets as a
-            ON p.preset_id = a.preset_id
-            WHERE
-                p.valid_to IS NULL
-                AND a.valid_to IS NULL;
-        """
+    def export_presets():
+        # Full definitions of every preset, in the form import_presets takes
+        presets = {'atomic': [], 'day': [], 'week': []}
+        for preset_type, preset in PresetCatalogue.get_all().values():
+            presets[preset_type].append(preset)
+        return presets
 
-        result = DatabaseManager.query_db(query)
+    @staticmethod
+    def check_preset_import(document):
+        # Presets may only refer to others in the same document (or to 0 for
+        # off), so an export can be imported into any database
+        types = {0: 'off'}
+        for preset_type in ['atomic', 'day', 'week']:
+            for preset in document.get(preset_type) or []:
+                if preset['id'] in types:
+                    return f"Preset id {preset['id']} is used more than once"
+                types[preset['id']] = preset_type
+
+        referable = {
+            'day': ['off', 'atomic'],
+            'week': ['off', 'atomic', 'day']
+        }
+        for preset_type, allowed in referable.items():
+            for preset in document.get(preset_type) or []:
+                for id in preset['preset']:
+                    if types.get(id) not in allowed:
+                        return f"{preset_type.capitalize()} preset {preset['id']} refers to {id}, which is not one of: {', '.join(allowed)}"
+        return None
 
-        return [{'id': row['preset_id'], 'name': row['name']} for row in result]
-    
     @staticmethod
-    def get_day_presets():
-        query = """
-            SELECT p.preset_id, p.name 
-            FROM preset_names as p
-            INNER JOIN day_preset_chunks as d
-            ON p.preset_id = d.preset_id
-            WHERE
-                p.valid_to IS NULL
-                AND d.valid_to IS NULL
-            GROUP BY p.preset_id;
-        """
+    @DatabaseManager.execute_db
+    def import_presets(cur, document):
+        atomic_presets = [PresetManager.format_from_api_atomic_preset(p) for p in document.get('atomic') or []]
+        day_presets = [PresetManager.format_from_api_day_preset(p) for p in document.get('day') or []]
+        week_presets = [PresetManager.format_from_api_week_preset(p) for p in document.get('week') or []]
+
+        # New ids are allocated up front, so that references can be remapped
+        # and every table written in one batch
+        cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'preset_ids';")
+        row = cur.fetchone()
+        next_id = (0 if row is None else row['seq']) + 1
+        ids = {0: 0}
+        types = {}
+        for preset_type, presets in [('atomic', atomic_presets), ('day', day_presets), ('week', week_presets)]:
+            for old_id, _ in presets:
+                ids[old_id] = next_id
+                types[next_id] = preset_type
+                next_id += 1
+
+        day_id_keys = ['monday_preset_id', 'tuesday_preset_id', 'wednesday_preset_id', 'thursday_preset_id', 'friday_preset_id', 'saturday_preset_id', 'sunday_preset_id']
+
+        cur.executemany(
+            "INSERT INTO preset_ids (id, type) VALUES (:id, :type);",
+            [{'id': id, 'type': preset_type} for id, preset_type in types.items()]
+        )
 
-        result = DatabaseManager.query_db(query)
+        PresetManager._insert_atomic_presets(cur, [
+            (ids[old_id], preset) for old_id, preset in atomic_presets
+        ])
+        PresetManager._insert_day_presets(cur, [
+            (ids[old_id], {
+                **preset, 
+                'chunks': [
+                    {**chunk, 'chunk_preset_id': ids[chunk['chunk_preset_id']]} 
+                    for chunk in preset['chunks']
+                ]
+            }) 
+            for old_id, preset in day_presets
+        ])
+        PresetManager._insert_week_presets(cur, [
+            (ids[old_id], {
+                **preset, 
+                **{key: ids[preset[key]] for key in day_id_keys}
+            }) 
+            for old_id, preset in week_presets
+        ])
+
+        return {old_id: new_id for old_id, new_id in ids.items() if old_id != 0}
 
-        return [{'id': row['preset_id'], 'name': row['name']} for row in result]
+    @staticmethod
+    def get_atomic_presets():
+        return PresetCatalogue.get_presets('atomic')
+    
+    @staticmethod
+    def get_day_presets():
+        return PresetCatalogue.get_presets('day')
     
     @staticmethod
     def get_week_presets():
-        query = """
-            SELECT p.preset_id, p.name 
-            FROM preset_names as p
-            INNER JOIN week_presets as w
-            ON p.preset_id = w.preset_id
-            WHERE
-                p.valid_to IS NULL
-                AND w.valid_to IS NULL;
-        """
-
-        result = DatabaseManager.query_db(query)
-
-        return [{'id': row['preset_id'], 'name': row['name']} for row in result]
+        return PresetCatalogue.get_presets('week')
     
 
     @staticmethod
-    def get_atomic_preset(id):
-        query = """
-            SELECT p.preset_id, p.name, a.core_high, a.core_low, a.oven_high, a.oven_low
-            FROM preset_names as p
-            INNER JOIN atomic_presets as a
-            ON p.preset_id = a.preset_id
-            WHERE
-                p.preset_id = :preset_id
-                AND p.valid_to IS NULL
-                AND a.valid_to IS NULL;
-        """
-
-        result = DatabaseManager.query_db(
-            query,
-            args={'preset_id': id},
-            one=True
-        )
-
-        return {
-            'id': result['preset_id'],
-            'name': result['name'],
-            'temperature': {
-                'core': {
-                    'high': result['core_high'],
-                    'low': result['core_low']
-                },
-                'oven': {
-                    'high': result['oven_high'],
-                    'low': result['oven_low']
-                }
-            }
-        }
+    def get_atomic_preset(id, at=None):
+        if at is not None:
+            return PresetCatalogue.get_preset_at('atomic', id, at)
+        return PresetCatalogue.get_preset('atomic', id)
     
     @staticmethod
-    def get_day_preset(id):
-        base_query = """
-            SELECT p.preset_id, p.name
-            FROM preset_names as p
-            INNER JOIN day_preset_chunks as d
-            ON p.preset_id = d.preset_id
-            WHERE
-                p.preset_id = :preset_id
-                AND p.valid_to IS NULL
-                AND d.valid_to IS NULL
-            GROUP BY p.preset_id;
-        """
-
-        base_result = DatabaseManager.query_db(
-            base_query,
-            args={'preset_id': id},
-            one=True
-        )
-
-        chunk_query = """
-            SELECT start, chunk_preset_id
-            FROM day_preset_chunks
-            WHERE
-                preset_id = :preset_id
-                AND valid_to IS NULL
-            ORDER BY start ASC;
-        """
-
-        chunk_result = DatabaseManager.query_db(
-            chunk_query,
-            args={'preset_id': id},
-        )
-
-        return {
-            'id': base_result['preset_id'],
-            'name': base_result['name'],
-            'preset': [chunk['chunk_preset_id'] for chunk in chunk_result],
-            'time': [{
-                    'hour': chunk['start'] // (60 * 60), 
-                    'minute': (chunk['start'] // 60) % 60
-                } for chunk in chunk_result[1:]]
-        }
+    def get_day_preset(id, at=None):
+        if at is not None:
+            return PresetCatalogue.get_preset_at('day', id, at)
+        return PresetCatalogue.get_preset('day', id)
     
     @staticmethod
-    def get_week_preset(id):
-        query = """
-            SELECT p.preset_id, p.name, a.monday_preset_id, a.tuesday_preset_id, a.wednesday_preset_id, a.thursday_preset_id, a.friday_preset_id, a.saturday_preset_id, a.sunday_preset_id
-            FROM preset_names as p
-            INNER JOIN week_presets as a
-            ON p.preset_id = a.preset_id
-            WHERE
-                p.preset_id = :preset_id
-                AND p.valid_to IS NULL
-                AND a.valid_to IS NULL;
-        """
+    def get_week_preset(id, at=None):
+        if at is not None:
+            return PresetCatalogue.get_preset_at('week', id, at)
+        return PresetCatalogue.get_preset('week', id)
 
-        result = DatabaseManager.query_db(
-            query,
-            args={'preset_id': id},
-            one=True
-        )
+    @staticmethod
+    def get_preset_details(ids, resolve_children=False):
+        return PresetCatalogue.get_preset_details(ids, resolve_children)
 
-        return {
-            'id': result['preset_id'],
-            'name': result['name'],
-            'preset': [
-                result['monday_preset_id'],
-                result['tuesday_preset_id'],
-                result['wednesday_preset_id'],
-                result['thursday_preset_id'],
-                result['friday_preset_id'],
-                result['saturday_preset_id'],
-                result['sunday_preset_id']
-            ]
-        }
     
 
 
@@ -456,6 +884,7 @@ class PresetManager():
     @staticmethod
     @DatabaseManager.execute_db
     def set_active(cur, id):
+        now = PresetManager._get_now(cur)
         cur.execute(
             """
                 INSERT INTO preset_history 
@@ -465,9 +894,13 @@ class PresetManager():
             """, 
             {'preset_id': id}
         )
+        PresetManager._refresh_timeline(cur, now)
     
     @staticmethod
-    def get_active():
+    def get_active(at=None):
+        if at is not None:
+            return PresetManager._get_active_at(at)
+
         query = """
             SELECT preset_id
             FROM preset_history
@@ -483,207 +916,535 @@ class PresetManager():
         if result is None:
             return {'id': 0}
         return {'id': result['preset_id']}
+
+    @staticmethod
+    def _get_active_at(at):
+        # Activations don't overlap, so this is a seek on active_from
+        query = """
+            SELECT preset_id
+            FROM preset_history
+            WHERE 
+                active_from = (
+                    SELECT max(active_from)
+                    FROM preset_history
+                    WHERE active_from <= :at
+                )
+                AND (active_to IS NULL OR active_to > :at);
+        """
+
+        result = DatabaseManager.query_db(
+            query,
+            args={'at': at},
+            one=True
+        )
+
+        if result is None:
+            return {'id': 0}
+        return {'id': result['preset_id']}
     
     @staticmethod
-    def get_temperatures(start, end):
+    def _query_temperatures(start, end, iterate=False):
         query = """
             SELECT time, core, oven, core_on, oven_on 
             FROM temperatures
             WHERE time BETWEEN :start AND :end;
         """
 
-        result = DatabaseManager.query_db(
+        fetch = DatabaseManager.iterate_db if iterate else DatabaseManager.query_db
+        return fetch(
             query,
             args={'start': start, 'end': end},
         )
 
-        return [{
+    @staticmethod
+    def _query_temperature_rollups(start, end, resolution, iterate=False):
+        query = f"""
+            SELECT 
+                time, 
+                round(core_sum * 1.0 / samples, 1) as core, 
+                core_min,
+                core_max,
+                round(oven_sum * 1.0 / samples, 1) as oven, 
+                oven_min,
+                oven_max,
+                core_on_count * 1.0 / samples as core_on, 
+                oven_on_count * 1.0 / samples as oven_on
+            FROM {PresetManager.rollup_tables[resolution]}
+            WHERE time BETWEEN :start AND :end;
+        """
+
+        fetch = DatabaseManager.iterate_db if iterate else DatabaseManager.query_db
+        return fetch(
+            query,
+            args={'start': start - (start % resolution), 'end': end},
+        )
+
+    @staticmethod
+    def _format_temperature(row):
+        return {
             'time': row['time'],
             'core': row['core'],
             'oven': row['oven'],
             'coreOn': bool(row['core_on']),
             'ovenOn': bool(row['oven_on'])
-        } for row in result]
-
+        }
 
+    @staticmethod
+    def get_temperatures(start, end):
+        result = PresetManager._query_temperatures(start, end)
+        return [PresetManager._format_temperature(row) for row in result]
 
     @staticmethod
-    def get_boxes(start, end):
-        active_presets_query = """
-            SELECT 
-                preset_id, 
-                max(active_from, :start) as active_from, 
-                min(COALESCE(active_to, unixepoch()), :end) as active_to
-            FROM preset_history
-            WHERE 
-                active_from < :end 
-                AND (
-                    active_to IS NULL 
-                    OR active_to > :start
-                );
+    def get_temperatures_after(after):
+        query = """
+            SELECT time, core, oven, core_on, oven_on 
+            FROM temperatures
+            WHERE time > :after
+            ORDER BY time ASC;
         """
 
-        active_presets_0 = DatabaseManager.query_db(
-            active_presets_query,
-            args={'start': start, 'end': end}
+        result = DatabaseManager.query_db(
+            query,
+            args={'after': after},
         )
 
+        return [PresetManager._format_temperature(row) for row in result]
+
+    @staticmethod
+    def get_latest_temperature_time():
+        result = DatabaseManager.query_db(
+            "SELECT COALESCE(max(time), 0) as time FROM temperatures;",
+            one=True
+        )
+        return result['time']
+
+    @staticmethod
+    def get_relay_state():
+        query = """
+            SELECT time, core_on, oven_on
+            FROM relay_state
+            WHERE id = 0;
+        """
+
+        result = DatabaseManager.query_db(query, one=True)
+
+        if result is None:
+            return None
+        return {
+            'time': result['time'],
+            'coreOn': bool(result['core_on']),
+            'ovenOn': bool(result['oven_on'])
+        }
+
+    @staticmethod
+    def _format_temperature_rollup(row):
+        return {
+            'time': row['time'],
+            'core': row['core'],
+            'coreMin': row['core_min'],
+            'coreMax': row['core_max'],
+            'oven': row['oven'],
+            'ovenMin': row['oven_min'],
+            'ovenMax': row['oven_max'],
+            'coreOn': row['core_on'] >= 0.5,
+            'ovenOn': row['oven_on'] >= 0.5,
+            'coreOnFraction': row['core_on'],
+            'ovenOnFraction': row['oven_on']
+        }
+
+    @staticmethod
+    def get_temperature_rollups(start, end, resolution):
+        result = PresetManager._query_temperature_rollups(start, end, resolution)
+        return [PresetManager._format_temperature_rollup(row) for row in result]
+
+    @staticmethod
+    def get_temperature_columns(start, end, resolution):
+        # Parallel arrays instead of an object per reading, with each time
+        # stored as the difference from the previous one (or from start)
+        is_rollup = resolution in PresetManager.rollup_tables
+        if is_rollup:
+            result = PresetManager._query_temperature_rollups(start, end, resolution)
+        else:
+            result = PresetManager._query_temperatures(start, end)
+
+        times = [row['time'] for row in result]
+        columns = {
+            'time': [t - prev for prev, t in zip([start, *times], times)],
+            'core': [row['core'] for row in result],
+            'oven': [row['oven'] for row in result],
+            'coreOn': [row['core_on'] >= 0.5 for row in result],
+            'ovenOn': [row['oven_on'] >= 0.5 for row in result]
+        }
+
+        if is_rollup:
+            columns.update({
+                'coreMin': [row['core_min'] for row in result],
+                'coreMax': [row['core_max'] for row in result],
+                'ovenMin': [row['oven_min'] for row in result],
+                'ovenMax': [row['oven_max'] for row in result],
+                'coreOnFraction': [row['core_on'] for row in result],
+                'ovenOnFraction': [row['oven_on'] for row in result]
+            })
+
+        return columns
+
+
+
+    @staticmethod
+    def _encode_active_presets(active_presets):
+        # Passed to sqlite as a single json parameter so that each level of
+        # presets can be joined in one statement
+        return json.dumps([
+            [p['preset_id'], p['active_from'], p['active_to']] 
+            for p in active_presets
+        ])
+
+    @staticmethod
+    def _resolve_limits(start, end):
+        # Expands the active week / day presets into the atomic presets 
+        # which were active between start and end, sorted by active_from.
+        # Runs one query per level of preset regardless of the range
         extract_week_presets = """
+            WITH active_presets AS (
+                SELECT 
+                    rowid as id,
+                    preset_id, 
+                    max(active_from, :start) as active_from, 
+                    min(COALESCE(active_to, :end), :end) as active_to
+                FROM preset_history
+                WHERE 
+                    active_from < :end 
+                    AND (
+                        active_to IS NULL 
+                        OR active_to > :start
+                    )
+                    -- Nothing before the activation at start can overlap
+                    AND active_from >= COALESCE((
+                        SELECT max(active_from) 
+                        FROM preset_history 
+                        WHERE active_from <= :start
+                    ), 0)
+            )
             SELECT 
-                preset_id, 
-                max(valid_from, :active_from) as active_from, 
-                min(COALESCE(valid_to, unixepoch()), :active_to) as active_to,
-                monday_preset_id, 
-                tuesday_preset_id, 
-                wednesday_preset_id, 
-                thursday_preset_id, 
-                friday_preset_id, 
-                saturday_preset_id, 
-                sunday_preset_id
-            FROM week_presets
-            WHERE 
-                preset_id = :preset_id
-                AND valid_from < :active_to
+                a.preset_id,
+                a.active_from,
+                a.active_to,
+                t.type,
+                max(w.valid_from, a.active_from) as week_active_from, 
+                min(COALESCE(w.valid_to, a.active_to), a.active_to) as week_active_to,
+                w.monday_preset_id, 
+                w.tuesday_preset_id, 
+                w.wednesday_preset_id, 
+                w.thursday_preset_id, 
+                w.friday_preset_id, 
+                w.saturday_preset_id, 
+                w.sunday_preset_id
+            FROM active_presets as a
+            INNER JOIN preset_ids as t
+            ON t.id = a.preset_id
+            LEFT JOIN week_presets as w
+            ON 
+                t.type = 'week'
+                AND w.preset_id = a.preset_id
+                AND w.valid_from < a.active_to
                 AND (
-                    valid_to IS NULL 
-                    OR valid_to > :active_from
-                );
+                    w.valid_to IS NULL 
+                    OR w.valid_to > a.active_from
+                )
+                AND w.valid_from >= COALESCE((
+                    SELECT max(valid_from) 
+                    FROM week_presets 
+                    WHERE preset_id = a.preset_id AND valid_from <= a.active_from
+                ), 0)
+            ORDER BY a.id ASC, w.valid_from ASC;
         """
 
-        week_presets = DatabaseManager.querymany_db(
+        week_presets = DatabaseManager.query_db(
             extract_week_presets,
-            args=(dict(row) for row in active_presets_0)
+            args={'start': start, 'end': end}
         )
 
-        active_presets_1 = []
-        for i in range(len(active_presets_0)):
-            if len(week_presets[i]) == 0:
-                # If the preset was atomic or day
-                active_presets_1.append(active_presets_0[i])
-                continue
-            
-            for preset in week_presets[i]:
-                active_from = preset['active_from']
-                active_to = preset['active_to']
+        day_id_keys = ['monday_preset_id', 'tuesday_preset_id', 'wednesday_preset_id', 'thursday_preset_id', 'friday_preset_id', 'saturday_preset_id', 'sunday_preset_id']
 
-                active_from_dt = datetime.fromtimestamp(active_from, tz=DatabaseManager.tz)
-                active_to_dt = datetime.fromtimestamp(active_to, tz=DatabaseManager.tz)
-                active_from_day = active_from_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                day_id_keys = ['monday_preset_id', 'tuesday_preset_id', 'wednesday_preset_id', 'thursday_preset_id', 'friday_preset_id', 'saturday_preset_id', 'sunday_preset_id']
+        # Every week and day preset is expanded against the same midnights
+        days = LocalDays(DatabaseManager.tz, start, end)
 
-                day_start = active_from_day
-                while day_start < active_to_dt:
-                    day_end = day_start + timedelta(days=1)
+        active_presets_1 = []
+        active_presets_2 = []
+        for preset in week_presets:
+            if preset['type'] == 'atomic':
+                # Atomic presets skip the day level
+                active_presets_2.append({
+                    'preset_id': preset['preset_id'],
+                    'active_from': preset['active_from'],
+                    'active_to': preset['active_to']
+                })
+                continue
 
-                    active_presets_1.append({
-                        'preset_id': preset[day_id_keys[day_start.weekday()]],
-                        'active_from': int(max(day_start, active_from_dt).timestamp()),
-                        'active_to': int(min(day_end, active_to_dt).timestamp())
-                    })
+            if preset['type'] == 'day':
+                active_presets_1.append({
+                    'preset_id': preset['preset_id'],
+                    'active_from': preset['active_from'],
+                    'active_to': preset['active_to']
+                })
+                continue
 
-                    day_start = day_end
+            if preset['week_active_from'] is None:
+                # If the oven was off
+                continue
 
+            active_from = preset['week_active_from']
+            active_to = preset['week_active_to']
+            for day in days.overlapping(active_from, active_to):
+                active_presets_1.append({
+                    'preset_id': preset[day_id_keys[days.weekday(day)]],
+                    'active_from': max(days.midnights[day], active_from),
+                    'active_to': min(days.midnights[day + 1], active_to)
+                })
+
+        # The versions of each day preset are loaded once for the whole
+        # range, rather than joined again for every day it was active
         extract_day_presets = """
             SELECT 
-                preset_id, 
-                max(valid_from, :active_from) as active_from, 
-                min(COALESCE(valid_to, unixepoch()), :active_to) as active_to, 
-                start, 
-                end, 
-                chunk_preset_id
-            FROM day_preset_chunks
-            WHERE 
-                preset_id = :preset_id
-                AND valid_from < :active_to
+                t.id as preset_id,
+                t.type,
+                d.start, 
+                d.end, 
+                d.chunk_preset_id,
+                d.valid_from,
+                d.valid_to
+            FROM preset_ids as t
+            LEFT JOIN day_preset_chunks as d
+            ON 
+                t.type = 'day'
+                AND d.preset_id = t.id
+                AND d.valid_from < :end
                 AND (
-                    valid_to IS NULL 
-                    OR valid_to > :active_from
-                );
+                    d.valid_to IS NULL 
+                    OR d.valid_to > :start
+                )
+            WHERE t.id IN (SELECT value FROM json_each(:preset_ids))
+            ORDER BY t.id ASC, d.valid_from ASC;
         """
 
-        day_presets = DatabaseManager.querymany_db(
+        day_presets = DatabaseManager.query_db(
             extract_day_presets,
-            args=(dict(row) for row in active_presets_1)
+            args={
+                'start': start,
+                'end': end,
+                'preset_ids': json.dumps(sorted({p['preset_id'] for p in active_presets_1}))
+            }
         )
 
-        active_presets_2 = []
-        for i in range(len(active_presets_1)):
-            if len(day_presets[i]) == 0:
-                # If the preset was atomic
-                active_presets_2.append(active_presets_1[i])
+        types = {}
+        rows = {}
+        for row in day_presets:
+            types[row['preset_id']] = row['type']
+            if row['type'] == 'day':
+                rows.setdefault(row['preset_id'], []).append(row)
+        chunks = {id: ChunkVersions(versions) for id, versions in rows.items()}
+
+        for preset in active_presets_1:
+            preset_type = types.get(preset['preset_id'])
+            if preset_type == 'atomic':
+                active_presets_2.append(preset)
                 continue
 
-            for preset in day_presets[i]:
-                active_from = preset['active_from']
-                active_to = preset['active_to']
+            if preset_type != 'day' or preset['preset_id'] not in chunks:
+                # If the oven was off
+                continue
 
-                active_from_dt = datetime.fromtimestamp(active_from, tz=DatabaseManager.tz)
-                active_to_dt = datetime.fromtimestamp(active_to, tz=DatabaseManager.tz)
-                active_from_day = active_from_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                start_td = timedelta(seconds=preset['start'])
-                end_td = timedelta(seconds=preset['end'])
+            for chunk in chunks[preset['preset_id']].overlapping(preset['active_from'], preset['active_to']):
+                active_from = max(chunk['valid_from'], preset['active_from'])
+                active_to = preset['active_to'] if chunk['valid_to'] is None else min(chunk['valid_to'], preset['active_to'])
+                for day in days.overlapping(active_from, active_to):
+                    chunk_start = max(days.at(day, chunk['start']), active_from)
+                    chunk_end = min(days.at(day, chunk['end']), active_to)
+                    if chunk_start < chunk_end:
+                        active_presets_2.append({
+                            'preset_id': chunk['chunk_preset_id'],
+                            'active_from': chunk_start,
+                            'active_to': chunk_end
+                        })
 
-                day_start = active_from_day
-                # Loop breaks when chunk starts after active period ends
-                while (day_start + start_td) < active_to_dt:
-                    chunk_start = int(max(day_start + start_td, active_from_dt).timestamp())
-                    chunk_end = int(min(day_start + end_td, active_to_dt).timestamp())
+        extract_atomic_presets = """
+            WITH active_presets AS (
+                SELECT 
+                    key as id,
+                    json_extract(value, '$[0]') as preset_id,
+                    json_extract(value, '$[1]') as active_from,
+                    json_extract(value, '$[2]') as active_to
+                FROM json_each(:active_presets)
+            )
+            SELECT 
+                p.preset_id, 
+                max(p.valid_from, a.active_from) as active_from, 
+                min(COALESCE(p.valid_to, a.active_to), a.active_to) as active_to, 
+                p.core_high,
+                p.core_low,
+                p.oven_high, 
+                p.oven_low
+            FROM active_presets as a
+            INNER JOIN atomic_presets as p
+            ON 
+                p.preset_id = a.preset_id
+                AND p.valid_from < a.active_to
+                AND (
+                    p.valid_to IS NULL 
+                    OR p.valid_to > a.active_from
+                )
+                AND p.valid_from >= COALESCE((
+                    SELECT max(valid_from) 
+                    FROM atomic_presets 
+                    WHERE preset_id = a.preset_id AND valid_from <= a.active_from
+                ), 0)
+            ORDER BY a.id ASC, p.valid_from ASC;
+        """
 
-                    day_start += timedelta(days=1)
+        atomic_presets = DatabaseManager.query_db(
+            extract_atomic_presets,
+            args={'active_presets': PresetManager._encode_active_presets(active_presets_2)}
+        )
 
-                    if not (chunk_start < chunk_end):
-                        continue
+        final_values = [dict(p) for p in atomic_presets]
+        final_values.sort(key=lambda x: x['active_from'])
+        return final_values
 
-                    active_presets_2.append({
-                        'preset_id': preset['chunk_preset_id'],
-                        'active_from': chunk_start,
-                        'active_to': chunk_end
-                    })
+    @staticmethod
+    def _identical_atomic_presets(p1, p2):
+        return (
+            p1['preset_id'] == p2['preset_id']
+            and p1['core_high'] == p2['core_high']
+            and p1['core_low'] == p2['core_low']
+            and p1['oven_high'] == p2['oven_high']
+            and p1['oven_low'] == p2['oven_low']
+        )
 
-        extract_atomic_presets = """
+
+
+
+
+    @staticmethod
+    def _get_now(cur):
+        cur.execute("SELECT unixepoch() as now;")
+        return cur.fetchone()['now']
+
+    @staticmethod
+    def _extend_timeline(cur, schedule, until, ahead=0):
+        cur.execute("SELECT materialized_to FROM limit_timeline_state;")
+        materialized_to = cur.fetchone()['materialized_to']
+        if materialized_to >= until:
+            return
+
+        # Only the part from before the current schedule took effect needs
+        # the full history to be resolved
+        until += ahead
+        split = min(max(materialized_to, schedule.valid_from), until)
+        intervals = []
+        if materialized_to < split:
+            intervals = PresetManager._resolve_limits(materialized_to, split)
+        intervals += schedule.between(split, until)
+
+        cur.execute(
+            """
+                SELECT start, end, preset_id, core_high, core_low, oven_high, oven_low
+                FROM limit_timeline
+                ORDER BY start DESC
+                LIMIT 1;
+            """
+        )
+        last = cur.fetchone()
+
+        rows = []
+        if last is not None:
+            last = dict(last)
+            last['active_from'] = last.pop('start')
+            last['active_to'] = last.pop('end')
+            rows.append(last)
+
+        for interval in intervals:
+            if (
+                len(rows) > 0
+                and rows[-1]['active_to'] == interval['active_from']
+                and PresetManager._identical_atomic_presets(rows[-1], interval)
+            ):
+                rows[-1]['active_to'] = interval['active_to']
+            else:
+                rows.append(interval)
+
+        if last is not None:
+            cur.execute(
+                """
+                    UPDATE limit_timeline
+                    SET end = :active_to
+                    WHERE start = :active_from;
+                """,
+                rows[0]
+            )
+            rows = rows[1:]
+
+        cur.executemany(
+            """
+                INSERT INTO limit_timeline
+                    (start, end, preset_id, core_high, core_low, oven_high, oven_low)
+                VALUES
+                    (:active_from, :active_to, :preset_id, :core_high, :core_low, :oven_high, :oven_low)
+            """,
+            rows
+        )
+        cur.execute(
+            """
+                UPDATE limit_timeline_state
+                SET materialized_to = :until;
+            """,
+            {'until': until}
+        )
+
+    @staticmethod
+    def _refresh_timeline(cur, since):
+        # Compiled without the shared resolver, as the write could still be
+        # rolled back
+        schedule = compile_schedule(cur, DatabaseManager.tz)
+        truncate_timeline(cur, since)
+        PresetManager._extend_timeline(cur, schedule, since, ahead=PresetManager.timeline_horizon)
+
+    @staticmethod
+    @DatabaseManager.execute_db
+    def extend_timeline(cur, until):
+        schedule = PresetManager.schedule_resolver.get_schedule(cur)
+        PresetManager._extend_timeline(cur, schedule, until, ahead=PresetManager.timeline_horizon)
+
+    @staticmethod
+    def get_boxes(start, end):
+        PresetManager.extend_timeline(end)
+
+        timeline_query = """
             SELECT 
                 preset_id, 
-                max(valid_from, :active_from) as active_from, 
-                min(COALESCE(valid_to, unixepoch()), :active_to) as active_to, 
+                max(start, :start) as active_from, 
+                min(end, :end, unixepoch()) as active_to,
                 core_high,
                 core_low,
                 oven_high, 
                 oven_low
-            FROM atomic_presets
+            FROM limit_timeline
             WHERE 
-                preset_id = :preset_id
-                AND valid_from < :active_to
-                AND (
-                    valid_to IS NULL 
-                    OR valid_to > :active_from
-                );
+                start >= (
+                    SELECT COALESCE(max(start), :start)
+                    FROM limit_timeline
+                    WHERE start <= :start
+                )
+                AND start < min(:end, unixepoch())
+                AND end > :start
+            ORDER BY start ASC;
         """
 
-        atomic_presets = DatabaseManager.querymany_db(
-            extract_atomic_presets,
-            args=(dict(row) for row in active_presets_2)
-        )
-
-        final_values = [dict(p) for row in atomic_presets for p in row]
-
-        def identical_atomic_presets(p1, p2):
-            return (
-                p1['preset_id'] == p2['preset_id']
-                and p1['core_high'] == p2['core_high']
-                and p1['core_low'] == p2['core_low']
-                and p1['oven_high'] == p2['oven_high']
-                and p1['oven_low'] == p2['oven_low']
-            )
-
-        final_values.sort(key=lambda x: x['active_from'])
-
-        i = 1
-        while i < len(final_values):
-            if identical_atomic_presets(final_values[i], final_values[i-1]):
-                duplicate_preset = final_values.pop(i)
-                final_values[i-1]['active_to'] = duplicate_preset['active_to']
+        final_values = []
+        for row in DatabaseManager.query_db(timeline_query, args={'start': start, 'end': end}):
+            if len(final_values) > 0 and PresetManager._identical_atomic_presets(final_values[-1], row):
+                final_values[-1]['active_to'] = row['active_to']
             else:
-                i += 1
+                final_values.append(dict(row))
 
         core = []
         oven = []
@@ -706,20 +1467,98 @@ class PresetManager():
             'oven': oven
         }
 
+
+    
     @staticmethod
-    def get_history(start, end):
+    def get_history_resolution(start, end):
+        # Finest resolution which doesn't exceed max_history_points
+        for resolution in [PresetManager.temperature_interval, *PresetManager.rollup_tables]:
+            if (end - start) // resolution <= PresetManager.max_history_points:
+                return resolution
+        return max(PresetManager.rollup_tables)
+
+    @staticmethod
+    def get_history(start, end, columnar=False):
+        resolution = PresetManager.get_history_resolution(start, end)
+        if columnar:
+            data = PresetManager.get_temperature_columns(start, end, resolution)
+        elif resolution in PresetManager.rollup_tables:
+            data = PresetManager.get_temperature_rollups(start, end, resolution)
+        else:
+            data = PresetManager.get_temperatures(start, end)
+
         return {
-            'data': PresetManager.get_temperatures(start, end),
+            'data': data,
             'limit': PresetManager.get_boxes(start, end),
             'start': start,
-            'end': end
+            'end': end,
+            'resolution': resolution
         }
-    
+
     @staticmethod
-    def get_history(start, end):
-        return {
-            'data': PresetManager.get_temperatures(start, end),
-            'limit': PresetManager.get_boxes(start, end),
-            'start': start,
-            'end': end
-        }
\ No newline at end of file
+    def stream_history(start, end):
+        # The same document as get_history, written out in pieces as the
+        # readings are read so that they are never all in memory. Keys are
+        # in the sorted order jsonify uses. The limits are resolved before
+        # anything is sent, so that a failure can still be reported
+        resolution = PresetManager.get_history_resolution(start, end)
+        limits = PresetManager.get_boxes(start, end)
+        if resolution in PresetManager.rollup_tables:
+            rows = PresetManager._query_temperature_rollups(start, end, resolution, iterate=True)
+            format_row = PresetManager._format_temperature_rollup
+        else:
+            rows = PresetManager._query_temperatures(start, end, iterate=True)
+            format_row = PresetManager._format_temperature
+
+        def dumps(value):
+            return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+        def generate():
+            yield '{"data":['
+            chunk = []
+            separator = ''
+            for row in rows:
+                chunk.append(dumps(format_row(row)))
+                if len(chunk) == PresetManager.history_chunk_rows:
+                    yield separator + ','.join(chunk)
+                    chunk = []
+                    separator = ','
+            if len(chunk) > 0:
+                yield separator + ','.join(chunk)
+            yield f'],"end":{dumps(end)},"limit":{dumps(limits)},"resolution":{dumps(resolution)},"start":{dumps(start)}}}'
+
+        return generate()
+
+
+
+class ControllerHealth():
+    # Summary of the controller's recent ticks, from the ring of timings it
+    # writes to controller_ticks
+    window = 60 * 60
+
+    @staticmethod
+    def get_summary(now):
+        query = """
+            SELECT
+                count(*) as ticks,
+                COALESCE(sum(NOT ok), 0) as failed,
+                max(time) as last_tick,
+                avg(drift_ms) as drift_ms_avg,
+                max(drift_ms) as drift_ms_max,
+                avg(duration_ms) as duration_ms_avg,
+                max(duration_ms) as duration_ms_max,
+                avg(sensor_ms) as sensor_ms_avg,
+                avg(db_ms) as db_ms_avg,
+                avg(relay_ms) as relay_ms_avg,
+                COALESCE(sum(lock_waits), 0) as lock_waits,
+                COALESCE(sum(relay_toggles), 0) as relay_toggles
+            FROM controller_ticks
+            WHERE time >= :since;
+        """
+
+        result = DatabaseManager.query_db(
+            query,
+            args={'since': now - ControllerHealth.window},
+            one=True
+        )
+        return dict(result)
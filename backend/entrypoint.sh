@@ -1,7 +1,13 @@
 #!/bin/sh
 
 # The path to the database file inside the container
-DB_FILE="/app/data/temperatures_and_presets.db"
+DB_FILE="${DB_NAME:-/app/data/temperatures_and_presets.db}"
+
+# Each gunicorn worker writes its request metrics here, cleared so that
+# counts from before a restart aren't mixed in
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
 # Check if the database file does not exist
 if [ ! -f "$DB_FILE" ]; then
@@ -9,8 +15,10 @@ if [ ! -f "$DB_FILE" ]; then
     flask init-db
     echo "Database initialized."
 else
-    echo "Database already exists."
+    echo "Database already exists. Applying migrations..."
+    flask migrate-db
 fi
 
-# Start the main application (Gunicorn)
+# Start the main application (Gunicorn), workers and threads are set in
+# gunicorn.conf.py
 exec gunicorn --bind 0.0.0.0:5000 app:app
\ No newline at end of file
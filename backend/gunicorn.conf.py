@@ -0,0 +1,15 @@
+import os
+from prometheus_client import multiprocess
+
+# Loaded by gunicorn from the working directory
+
+# Threaded workers, as each open temperature stream holds a thread for as
+# long as it is connected. Only MAX_STREAMS of each worker's threads can be
+# streams, so the rest are always free for other requests
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 16))
+
+def child_exit(server, worker):
+    # Stops a dead worker's in-flight requests counting towards the total
+    multiprocess.mark_process_dead(worker.pid)
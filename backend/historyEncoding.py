@@ -0,0 +1,73 @@
+import struct
+
+# Binary encoding of a columnar history, all values little-endian. Every
+# temperature, including rollups and boxes, is in tenths of a degree.
+# Sections are ordered from the widest type to the narrowest, so each array
+# starts aligned to its own size and can be read with a typed array view
+#
+# Header:     uint32 start, end, resolution, reading count (n), box count (m)
+# Times:      int32[n]  time, each relative to the previous reading (or start)
+#             int32[m]  box start relative to the header start
+#             int32[m]  box end relative to the header start
+# Readings:   int16[n]  core
+#             int16[n]  oven
+# Rollups:    int16[n]  core min, core max, oven min, oven max
+#             (only present when resolution is not the raw interval)
+# Boxes:      int16[m]  core max, core min, oven max, oven min
+# Relays:     uint8[n]  core on, percentage of the reading the relay was on
+#             uint8[n]  oven on, percentage of the reading the relay was on
+
+HISTORY_MIMETYPE = 'application/vnd.oven-history'
+
+_HEADER = struct.Struct('<5I')
+
+
+def _pack(fmt, values):
+    return struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+def _pack_temperatures(temperatures):
+    return _pack('h', [round(t * 10) for t in temperatures])
+
+
+def pack_history(history):
+    data = history['data']
+    is_rollup = 'coreMin' in data
+    core_boxes = history['limit']['core']
+    oven_boxes = history['limit']['oven']
+    start = history['start']
+
+    if is_rollup:
+        core_on = data['coreOnFraction']
+        oven_on = data['ovenOnFraction']
+    else:
+        core_on = data['coreOn']
+        oven_on = data['ovenOn']
+
+    parts = [
+        _HEADER.pack(start, history['end'], history['resolution'], len(data['time']), len(core_boxes)),
+        _pack('i', data['time']),
+        _pack('i', [box['start'] - start for box in core_boxes]),
+        _pack('i', [box['end'] - start for box in core_boxes]),
+        _pack_temperatures(data['core']),
+        _pack_temperatures(data['oven'])
+    ]
+
+    if is_rollup:
+        parts += [
+            _pack_temperatures(data['coreMin']),
+            _pack_temperatures(data['coreMax']),
+            _pack_temperatures(data['ovenMin']),
+            _pack_temperatures(data['ovenMax'])
+        ]
+
+    parts += [
+        _pack_temperatures([box['max'] for box in core_boxes]),
+        _pack_temperatures([box['min'] for box in core_boxes]),
+        _pack_temperatures([box['max'] for box in oven_boxes]),
+        _pack_temperatures([box['min'] for box in oven_boxes]),
+        _pack('B', [round(f * 100) for f in core_on]),
+        _pack('B', [round(f * 100) for f in oven_on])
+    ]
+
+    return b''.join(parts)
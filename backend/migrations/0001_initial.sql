@@ -0,0 +1,184 @@
+-- Everything added to the schema since the original one, so that databases
+-- created before migrations existed can be upgraded in place
+
+-- Versions -------------------------------------------------------------------
+
+-- Bumped whenever the data behind a group of endpoints changes, used to tag
+-- responses so unchanged data doesn't need to be queried again
+CREATE TABLE data_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+-- Start from the creation time so tags from a previous database aren't reused
+INSERT INTO data_versions (name, version) 
+VALUES ('presets', unixepoch()), ('preset_history', unixepoch());
+
+CREATE TRIGGER version_preset_names
+AFTER INSERT ON preset_names
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'presets';
+END;
+
+CREATE TRIGGER version_atomic_presets
+AFTER INSERT ON atomic_presets
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'presets';
+END;
+
+CREATE TRIGGER version_day_preset_chunks
+AFTER INSERT ON day_preset_chunks
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'presets';
+END;
+
+CREATE TRIGGER version_week_presets
+AFTER INSERT ON week_presets
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'presets';
+END;
+
+CREATE TRIGGER version_insert_preset_history
+AFTER INSERT ON preset_history
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'preset_history';
+END;
+
+CREATE TRIGGER version_update_preset_history
+AFTER UPDATE ON preset_history
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'preset_history';
+END;
+
+-- Rollups --------------------------------------------------------------------
+
+-- Rollups are keyed by the start of their bucket, and store sums and counts
+-- so they can be updated one reading at a time
+
+CREATE TABLE temperatures_5m (
+    time INTEGER PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    core_min INTEGER NOT NULL,
+    core_max INTEGER NOT NULL,
+    core_sum INTEGER NOT NULL,
+    oven_min INTEGER NOT NULL,
+    oven_max INTEGER NOT NULL,
+    oven_sum INTEGER NOT NULL,
+    core_on_count INTEGER NOT NULL,
+    oven_on_count INTEGER NOT NULL
+);
+
+CREATE TABLE temperatures_1h (
+    time INTEGER PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    core_min INTEGER NOT NULL,
+    core_max INTEGER NOT NULL,
+    core_sum INTEGER NOT NULL,
+    oven_min INTEGER NOT NULL,
+    oven_max INTEGER NOT NULL,
+    oven_sum INTEGER NOT NULL,
+    core_on_count INTEGER NOT NULL,
+    oven_on_count INTEGER NOT NULL
+);
+
+-- Built from the existing readings, after which the trigger created below
+-- keeps them up to date
+
+INSERT INTO temperatures_5m
+    (time, samples, core_min, core_max, core_sum, oven_min, oven_max, oven_sum, core_on_count, oven_on_count)
+SELECT
+    time - time % 300, count(*), min(core), max(core), sum(core), min(oven), max(oven), sum(oven), sum(core_on), sum(oven_on)
+FROM temperatures
+GROUP BY time - time % 300;
+
+INSERT INTO temperatures_1h
+    (time, samples, core_min, core_max, core_sum, oven_min, oven_max, oven_sum, core_on_count, oven_on_count)
+SELECT
+    time - time % 3600, count(*), min(core), max(core), sum(core), min(oven), max(oven), sum(oven), sum(core_on), sum(oven_on)
+FROM temperatures
+GROUP BY time - time % 3600;
+
+-- Limit Timeline -------------------------------------------------------------
+
+-- Resolved atomic limits, so that reads don't need to expand the week and 
+-- day presets again. Kept up to date by the backend whenever the active
+-- preset or a preset definition changes
+
+CREATE TABLE limit_timeline (
+    start INTEGER PRIMARY KEY,
+    end INTEGER NOT NULL,
+    preset_id INTEGER NOT NULL REFERENCES preset_ids (preset_id),
+    core_high INTEGER NOT NULL,
+    core_low INTEGER NOT NULL,
+    oven_high INTEGER NOT NULL,
+    oven_low INTEGER NOT NULL,
+    CHECK (end > start)
+);
+
+-- The timeline is complete up until materialized_to
+CREATE TABLE limit_timeline_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    materialized_to INTEGER NOT NULL
+);
+
+-- Any existing history is resolved into the timeline when it is next read
+INSERT INTO limit_timeline_state (id, materialized_to)
+VALUES (0, COALESCE((SELECT min(active_from) FROM preset_history), unixepoch()));
+
+-- Temperatures ---------------------------------------------------------------
+
+-- Cluster temperatures on time so range scans read consecutive pages, 
+-- replacing the rowid table and its separate UNIQUE index
+
+CREATE TABLE temperatures_clustered (
+    time INTEGER PRIMARY KEY,
+    core INTEGER NOT NULL,
+    oven INTEGER NOT NULL,
+    core_on BOOLEAN NOT NULL,
+    oven_on BOOLEAN NOT NULL
+) WITHOUT ROWID;
+
+INSERT INTO temperatures_clustered
+    (time, core, oven, core_on, oven_on)
+SELECT time, core, oven, core_on, oven_on
+FROM temperatures
+ORDER BY time ASC;
+
+-- The rollup trigger goes with the old table, and is created again below
+DROP TABLE temperatures;
+
+ALTER TABLE temperatures_clustered RENAME TO temperatures;
+
+CREATE TRIGGER rollup_temperatures
+AFTER INSERT ON temperatures
+BEGIN
+    INSERT INTO temperatures_5m
+        (time, samples, core_min, core_max, core_sum, oven_min, oven_max, oven_sum, core_on_count, oven_on_count)
+    VALUES
+        (NEW.time - NEW.time % 300, 1, NEW.core, NEW.core, NEW.core, NEW.oven, NEW.oven, NEW.oven, NEW.core_on, NEW.oven_on)
+    ON CONFLICT (time) DO UPDATE SET
+        samples = samples + 1,
+        core_min = min(core_min, excluded.core_min),
+        core_max = max(core_max, excluded.core_max),
+        core_sum = core_sum + excluded.core_sum,
+        oven_min = min(oven_min, excluded.oven_min),
+        oven_max = max(oven_max, excluded.oven_max),
+        oven_sum = oven_sum + excluded.oven_sum,
+        core_on_count = core_on_count + excluded.core_on_count,
+        oven_on_count = oven_on_count + excluded.oven_on_count;
+
+    INSERT INTO temperatures_1h
+        (time, samples, core_min, core_max, core_sum, oven_min, oven_max, oven_sum, core_on_count, oven_on_count)
+    VALUES
+        (NEW.time - NEW.time % 3600, 1, NEW.core, NEW.core, NEW.core, NEW.oven, NEW.oven, NEW.oven, NEW.core_on, NEW.oven_on)
+    ON CONFLICT (time) DO UPDATE SET
+        samples = samples + 1,
+        core_min = min(core_min, excluded.core_min),
+        core_max = max(core_max, excluded.core_max),
+        core_sum = core_sum + excluded.core_sum,
+        oven_min = min(oven_min, excluded.oven_min),
+        oven_max = max(oven_max, excluded.oven_max),
+        oven_sum = oven_sum + excluded.oven_sum,
+        core_on_count = core_on_count + excluded.core_on_count,
+        oven_on_count = oven_on_count + excluded.oven_on_count;
+END;
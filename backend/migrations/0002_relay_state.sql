@@ -0,0 +1,9 @@
+-- Latest relay state, written by the controller whenever it switches a relay
+-- so that changes between the minute records can be streamed
+
+CREATE TABLE relay_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    time INTEGER NOT NULL,
+    core_on BOOLEAN NOT NULL,
+    oven_on BOOLEAN NOT NULL
+);
@@ -0,0 +1,20 @@
+-- Timings of the controller's recent ticks, written by the controller into a
+-- ring of slots so the table never grows past a day of ticks
+
+CREATE TABLE controller_ticks (
+    slot INTEGER PRIMARY KEY,
+    -- Second the tick was scheduled for
+    time INTEGER NOT NULL,
+    -- How late the tick started, and how long each part of it took
+    drift_ms REAL NOT NULL,
+    duration_ms REAL NOT NULL,
+    sensor_ms REAL NOT NULL,
+    db_ms REAL NOT NULL,
+    relay_ms REAL NOT NULL,
+    lock_waits INTEGER NOT NULL,
+    relay_toggles INTEGER NOT NULL,
+    ok BOOLEAN NOT NULL
+);
+
+CREATE INDEX controller_ticks_time
+ON controller_ticks(time);
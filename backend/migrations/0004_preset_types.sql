@@ -0,0 +1,132 @@
+-- Store each preset's type once in preset_ids, so the insert triggers can
+-- check it with one lookup instead of probing the other type tables, and
+-- readers can branch on it. Presets are typed when their id is created
+
+ALTER TABLE preset_ids ADD COLUMN type TEXT CHECK (type IN ('off', 'atomic', 'day', 'week'));
+
+UPDATE preset_ids
+SET type = CASE
+    WHEN id = 0 THEN 'off'
+    WHEN EXISTS (SELECT 1 FROM atomic_presets WHERE preset_id = preset_ids.id) THEN 'atomic'
+    WHEN EXISTS (SELECT 1 FROM day_preset_chunks WHERE preset_id = preset_ids.id) THEN 'day'
+    WHEN EXISTS (SELECT 1 FROM week_presets WHERE preset_id = preset_ids.id) THEN 'week'
+END;
+
+CREATE TRIGGER update_preset_ids
+BEFORE UPDATE OF type ON preset_ids
+WHEN OLD.type IS NOT NULL
+BEGIN
+    SELECT RAISE(ABORT, 'Cannot change the type of a preset');
+END;
+
+DROP TRIGGER insert_atomic_presets;
+DROP TRIGGER insert_day_preset_chunks;
+DROP TRIGGER insert_week_presets;
+
+CREATE TRIGGER insert_atomic_presets
+BEFORE INSERT ON atomic_presets
+BEGIN
+    -- Cancel if inserting invalidated
+    SELECT RAISE(ABORT, 'Cannot insert invalidated record') 
+    WHERE NEW.valid_to IS NOT NULL;
+
+    -- Cancel if the preset is of another type
+    SELECT RAISE(ABORT, 'Preset is of a different type') 
+    WHERE NOT EXISTS (
+        SELECT 1 FROM preset_ids WHERE id = NEW.preset_id AND type = 'atomic'
+    );
+
+    -- If there are no changes then skip insertion
+    SELECT RAISE(IGNORE)
+    WHERE EXISTS (
+        SELECT 1 FROM atomic_presets 
+        WHERE 
+            preset_id = NEW.preset_id 
+            AND valid_to IS NULL
+            AND core_high = NEW.core_high
+            AND core_low = NEW.core_low
+            AND oven_high = NEW.oven_high
+            AND oven_low = NEW.oven_low
+    );
+
+    -- Make the previous preset invalidated before inserting
+    UPDATE atomic_presets
+    SET valid_to = NEW.valid_from
+    WHERE
+        preset_id = NEW.preset_id
+        AND valid_to IS NULL;
+END;
+
+CREATE TRIGGER insert_day_preset_chunks
+BEFORE INSERT ON day_preset_chunks
+BEGIN
+    -- Cancel if inserting invalidated
+    SELECT RAISE(ABORT, 'Cannot insert invalidated record') WHERE NEW.valid_to IS NOT NULL;
+
+    -- Cancel if the preset is of another type
+    SELECT RAISE(ABORT, 'Preset is of a different type') 
+    WHERE NOT EXISTS (
+        SELECT 1 FROM preset_ids WHERE id = NEW.preset_id AND type = 'day'
+    );
+
+    -- If there are no changes then skip insertion
+    SELECT RAISE(IGNORE)
+    WHERE EXISTS (
+        SELECT 1 FROM day_preset_chunks 
+        WHERE 
+            preset_id = NEW.preset_id 
+            AND valid_to IS NULL
+            AND start = NEW.start
+            AND end = NEW.end
+            AND chunk_preset_id = NEW.chunk_preset_id
+    );
+
+    -- Make overlapping presets invalidated before inserting
+    UPDATE day_preset_chunks
+    SET valid_to = NEW.valid_from
+    WHERE
+        preset_id = NEW.preset_id
+        AND valid_to IS NULL
+        AND start < NEW.end AND end > NEW.start;
+
+    -- Note: this approach could leave blank spaces withing a day
+    -- To prevent this checks are made within the program before 
+    -- inserting to ensure there are no gaps in the inserted chunks
+    -- All chunks are also inserted in a single transaction
+END;
+
+CREATE TRIGGER insert_week_presets
+BEFORE INSERT ON week_presets
+BEGIN
+    -- Cancel if inserting invalidated
+    SELECT RAISE(ABORT, 'Cannot insert invalidated record') WHERE NEW.valid_to IS NOT NULL;
+
+    -- Cancel if the preset is of another type
+    SELECT RAISE(ABORT, 'Preset is of a different type') 
+    WHERE NOT EXISTS (
+        SELECT 1 FROM preset_ids WHERE id = NEW.preset_id AND type = 'week'
+    );
+
+    -- If there are no changes then skip insertion
+    SELECT RAISE(IGNORE)
+    WHERE EXISTS (
+        SELECT 1 FROM week_presets 
+        WHERE 
+            preset_id = NEW.preset_id 
+            AND valid_to IS NULL
+            AND monday_preset_id = NEW.monday_preset_id
+            AND tuesday_preset_id = NEW.tuesday_preset_id
+            AND wednesday_preset_id = NEW.wednesday_preset_id
+            AND thursday_preset_id = NEW.thursday_preset_id
+            AND friday_preset_id = NEW.friday_preset_id
+            AND saturday_preset_id = NEW.saturday_preset_id
+            AND sunday_preset_id = NEW.sunday_preset_id
+    );
+
+    -- Make the previous preset invalidated before inserting
+    UPDATE week_presets
+    SET valid_to = NEW.valid_from
+    WHERE
+        preset_id = NEW.preset_id
+        AND valid_to IS NULL;
+END;
@@ -0,0 +1,6 @@
+-- Versions are read as of a time by seeking to the latest one starting at
+-- or before it. The primary keys of the preset tables already lead with
+-- (preset_id, valid_from), but preset_history had no index on active_from
+
+CREATE INDEX preset_history_validity
+ON preset_history(active_from, active_to, preset_id);
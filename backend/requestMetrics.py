@@ -0,0 +1,117 @@
+import os
+import time
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from databaseManager import ControllerHealth
+
+# Per route request metrics in Prometheus format. Under gunicorn each worker
+# writes its values to PROMETHEUS_MULTIPROC_DIR, and /metrics reads every
+# worker's files so the totals don't depend on which worker answers
+
+# Streams are counted until their response starts, not until they close
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+REQUEST_LATENCY = Histogram(
+    'oven_request_duration_seconds',
+    "Time taken to handle a request",
+    ['method', 'route'],
+    buckets=LATENCY_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    'oven_response_size_bytes',
+    "Size of response bodies with a known length",
+    ['method', 'route'],
+    buckets=SIZE_BUCKETS
+)
+REQUESTS = Counter(
+    'oven_requests',
+    "Requests handled",
+    ['method', 'route', 'status']
+)
+IN_FLIGHT = Gauge(
+    'oven_requests_in_flight',
+    "Requests currently being handled",
+    ['method', 'route'],
+    multiprocess_mode='livesum'
+)
+
+
+def _route():
+    # The rule rather than the path, so ids in the path can't add labels
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def _record(status, response=None):
+    labels = {'method': request.method, 'route': _route()}
+    REQUEST_LATENCY.labels(**labels).observe(time.perf_counter() - g.request_started)
+    REQUESTS.labels(**labels, status=str(status)).inc()
+    if response is not None and response.content_length is not None:
+        RESPONSE_SIZE.labels(**labels).observe(response.content_length)
+    g.request_recorded = True
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.request_recorded = False
+        IN_FLIGHT.labels(method=request.method, route=_route()).inc()
+
+    @app.after_request
+    def finish_request(response):
+        _record(response.status_code, response)
+        return response
+
+    @app.teardown_request
+    def teardown_request(e=None):
+        if 'request_started' not in g:
+            return
+        IN_FLIGHT.labels(method=request.method, route=_route()).dec()
+        # after_request is skipped when the view raised
+        if not g.request_recorded:
+            _record(500)
+
+
+class ControllerCollector():
+    # Read from the database on each scrape, as the controller runs in its
+    # own container and only shares the database with the backend
+    gauges = {
+        'ticks': "Controller ticks in the last hour",
+        'failed': "Controller ticks in the last hour which failed",
+        'last_tick': "Scheduled time of the controller's last recorded tick",
+        'drift_ms_avg': "Mean milliseconds ticks started late in the last hour",
+        'drift_ms_max': "Most milliseconds a tick started late in the last hour",
+        'duration_ms_avg': "Mean milliseconds taken by a tick in the last hour",
+        'duration_ms_max': "Most milliseconds taken by a tick in the last hour",
+        'sensor_ms_avg': "Mean milliseconds spent reading sensors in the last hour",
+        'db_ms_avg': "Mean milliseconds spent in the database in the last hour",
+        'relay_ms_avg': "Mean milliseconds spent switching relays in the last hour",
+        'lock_waits': "Times the controller waited on a database lock in the last hour",
+        'relay_toggles': "Times a relay was switched in the last hour"
+    }
+
+    def collect(self):
+        summary = ControllerHealth.get_summary(int(time.time()))
+        for name, documentation in ControllerCollector.gauges.items():
+            if summary[name] is not None:
+                yield GaugeMetricFamily(f"oven_controller_{name}", documentation, value=summary[name])
+
+
+def metrics_response():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    controller_registry = CollectorRegistry(auto_describe=False)
+    controller_registry.register(ControllerCollector())
+
+    return Response(
+        generate_latest(registry) + generate_latest(controller_registry), 
+        mimetype=CONTENT_TYPE_LATEST
+    )
@@ -1,4 +1,4 @@
-from validateRequest import ConstraintSchema, DictSchema, ListSchema, expected_keys
+from validateRequest import ConstraintSchema, DictSchema, ListSchema, compile_schemas, expected_keys
 
 class AtomicPresetSchemas():
     _min_temp = 0
@@ -147,9 +147,27 @@ class CurrentPreset():
         )
     }))
 
+class PresetImportSchemas():
+    # Each list is optional, and references are checked against the other
+    # presets in the document once it is valid
+    import_ = expected_keys(DictSchema({
+        'atomic': ConstraintSchema(ListSchema(AtomicPresetSchemas.edit), optional=True),
+        'day': ConstraintSchema(ListSchema(DayPresetSchemas.edit), optional=True),
+        'week': ConstraintSchema(ListSchema(WeekPresetSchemas.edit), optional=True)
+    }))
+
 class RequestSchemas():
     atomicPreset = AtomicPresetSchemas
     dayPreset = DayPresetSchemas
     weekPreset = WeekPresetSchemas
     currentPreset = CurrentPreset
-    
\ No newline at end of file
+    presetImport = PresetImportSchemas
+    
+
+compile_schemas(
+    AtomicPresetSchemas,
+    DayPresetSchemas,
+    WeekPresetSchemas,
+    CurrentPreset,
+    PresetImportSchemas
+)
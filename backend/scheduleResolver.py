@@ -0,0 +1,289 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import threading
+
+# Shared by the backend and the controller, so this must only depend on a
+# plain sqlite3 cursor with sqlite3.Row as its row factory
+
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+
+
+class LocalDays():
+    # Timestamps of the local midnights from the day containing start until
+    # the first one after end, so that times of day can be found with
+    # integer arithmetic instead of a datetime for every day of every
+    # preset. Days where the UTC offset changes still go through datetime
+    def __init__(self, tz, start, end):
+        day = datetime.fromtimestamp(start, tz=tz).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.first_weekday = day.weekday()
+        self.midnights = array('q')
+        self.changes = {}
+        while True:
+            self.midnights.append(int(day.timestamp()))
+            if self.midnights[-1] > end:
+                break
+            next_day = day + timedelta(days=1)
+            if day.utcoffset() != next_day.utcoffset():
+                self.changes[len(self.midnights) - 1] = day
+            day = next_day
+
+    def overlapping(self, start, end):
+        # Indexes of the days with any part between start and end
+        return range(bisect_right(self.midnights, start) - 1, bisect_left(self.midnights, end))
+
+    def weekday(self, day):
+        return (self.first_weekday + day) % 7
+
+    def at(self, day, seconds):
+        # Timestamp of the local time seconds after midnight on a day
+        if day in self.changes:
+            return int((self.changes[day] + timedelta(seconds=seconds)).timestamp())
+        return self.midnights[day] + seconds
+
+
+class ChunkVersions():
+    # Every version of one day preset's chunks, indexed so that those
+    # overlapping a period are found without scanning the rest. A version
+    # is only ever ended by a newer one starting, so the versions valid at
+    # a time are among those valid at the latest valid_from before it
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda row: (row['valid_from'], row['start']))
+        self.valid_from = [row['valid_from'] for row in self.rows]
+        self.times = sorted(set(self.valid_from))
+        self.valid = []
+
+        valid = []
+        i = 0
+        for time in self.times:
+            valid = [j for j in valid if self.rows[j]['valid_to'] is None or self.rows[j]['valid_to'] > time]
+            while i < len(self.rows) and self.rows[i]['valid_from'] == time:
+                valid.append(i)
+                i += 1
+            self.valid.append(valid)
+
+    def overlapping(self, start, end):
+        # In the order of their start within the day
+        latest = bisect_right(self.times, start) - 1
+        found = [] if latest < 0 else [
+            j for j in self.valid[latest]
+            if self.rows[j]['valid_to'] is None or self.rows[j]['valid_to'] > start
+        ]
+        found += range(bisect_right(self.valid_from, start), bisect_left(self.valid_from, end))
+        return sorted((self.rows[j] for j in found), key=lambda row: (row['start'], row['valid_from']))
+
+
+class Schedule():
+    # The active preset compiled into the points within a week where the
+    # limits change. Offsets are seconds into the week by the local clock
+    # (Monday 00:00 is 0), and limits[i] applies from offsets[i] until
+    # offsets[i+1]. None is used when the oven should be off
+    def __init__(self, tz, valid_from, offsets, limits):
+        self.tz = tz
+        self.valid_from = valid_from
+        self.offsets = offsets
+        self.limits = limits
+
+    @staticmethod
+    def _week_start(dt):
+        monday = dt - timedelta(days=dt.weekday())
+        return monday.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def _week_offset(dt):
+        return (dt.weekday() * DAY) + (dt.hour * 60 * 60) + (dt.minute * 60) + dt.second
+
+    def at(self, timestamp):
+        dt = datetime.fromtimestamp(timestamp, tz=self.tz)
+        return self.limits[bisect_right(self.offsets, Schedule._week_offset(dt)) - 1]
+
+    def between(self, start, end):
+        # The limits between start and end, in the same form as
+        # PresetManager._resolve_limits
+        intervals = []
+        start_dt = datetime.fromtimestamp(start, tz=self.tz)
+        first = bisect_right(self.offsets, Schedule._week_offset(start_dt)) - 1
+
+        # Counted in days from the Monday starting the first week, with a
+        # week spare for the end of the last interval
+        week_start = int(Schedule._week_start(start_dt).timestamp())
+        days = LocalDays(self.tz, week_start, end + WEEK)
+        week = 0
+
+        while True:
+            for i in range(first, len(self.offsets)):
+                active_from = days.at(week + (self.offsets[i] // DAY), self.offsets[i] % DAY)
+                if active_from >= end:
+                    return intervals
+
+                next_offset = self.offsets[i+1] if i + 1 < len(self.offsets) else WEEK
+                active_to = days.at(week + (next_offset // DAY), next_offset % DAY)
+
+                active_from = max(active_from, start)
+                active_to = min(active_to, end)
+                if self.limits[i] is None or not (active_from < active_to):
+                    continue
+
+                if (
+                    len(intervals) > 0
+                    and intervals[-1]['active_to'] == active_from
+                    and intervals[-1]['preset_id'] == self.limits[i]['preset_id']
+                ):
+                    intervals[-1]['active_to'] = active_to
+                    continue
+
+                intervals.append({
+                    **self.limits[i],
+                    'active_from': active_from,
+                    'active_to': active_to
+                })
+
+            week += 7
+            first = 0
+
+
+def compile_schedule(cur, tz):
+    cur.execute("""
+        SELECT h.preset_id, h.active_from, t.type
+        FROM preset_history as h
+        INNER JOIN preset_ids as t
+        ON t.id = h.preset_id
+        WHERE h.active_to IS NULL;
+    """)
+    active = cur.fetchone()
+
+    if active is None:
+        cur.execute("SELECT COALESCE(max(active_to), 0) as active_to FROM preset_history;")
+        return Schedule(tz, cur.fetchone()['active_to'], [0], [None])
+
+    cur.execute("SELECT id, type FROM preset_ids;")
+    preset_types = {row['id']: row['type'] for row in cur.fetchall()}
+
+    cur.execute("""
+        SELECT preset_id, core_high, core_low, oven_high, oven_low, valid_from
+        FROM atomic_presets
+        WHERE valid_to IS NULL;
+    """)
+    atomic_presets = {row['preset_id']: row for row in cur.fetchall()}
+
+    cur.execute("""
+        SELECT preset_id, start, chunk_preset_id, valid_from
+        FROM day_preset_chunks
+        WHERE valid_to IS NULL
+        ORDER BY preset_id ASC, start ASC;
+    """)
+    day_presets = {}
+    for row in cur.fetchall():
+        day_presets.setdefault(row['preset_id'], []).append(row)
+
+    week_preset = None
+    if active['type'] == 'week':
+        cur.execute("""
+            SELECT preset_id, monday_preset_id, tuesday_preset_id, wednesday_preset_id, thursday_preset_id, friday_preset_id, saturday_preset_id, sunday_preset_id, valid_from
+            FROM week_presets
+            WHERE preset_id = :preset_id AND valid_to IS NULL;
+        """, {'preset_id': active['preset_id']})
+        week_preset = cur.fetchone()
+
+    valid_from = active['active_from']
+
+    def atomic_limits(preset_id):
+        nonlocal valid_from
+        preset = atomic_presets.get(preset_id)
+        if preset is None:
+            return None
+        valid_from = max(valid_from, preset['valid_from'])
+        return {
+            'preset_id': preset['preset_id'],
+            'core_high': preset['core_high'],
+            'core_low': preset['core_low'],
+            'oven_high': preset['oven_high'],
+            'oven_low': preset['oven_low']
+        }
+
+    def day_transitions(preset_id):
+        nonlocal valid_from
+        if preset_types.get(preset_id) != 'day':
+            return [(0, atomic_limits(preset_id))]
+        # A day preset without current chunks has no limits, rather than
+        # being looked up as an atomic preset
+        if preset_id not in day_presets:
+            return [(0, None)]
+        transitions = []
+        for chunk in day_presets[preset_id]:
+            valid_from = max(valid_from, chunk['valid_from'])
+            transitions.append((chunk['start'], atomic_limits(chunk['chunk_preset_id'])))
+        return transitions
+
+    if week_preset is None:
+        days = [active['preset_id']] * 7
+    else:
+        valid_from = max(valid_from, week_preset['valid_from'])
+        days = [
+            week_preset['monday_preset_id'],
+            week_preset['tuesday_preset_id'],
+            week_preset['wednesday_preset_id'],
+            week_preset['thursday_preset_id'],
+            week_preset['friday_preset_id'],
+            week_preset['saturday_preset_id'],
+            week_preset['sunday_preset_id']
+        ]
+
+    offsets = []
+    limits = []
+    for day, preset_id in enumerate(days):
+        for start, day_limits in day_transitions(preset_id):
+            if len(limits) > 0 and limits[-1] == day_limits:
+                continue
+            offsets.append((day * DAY) + start)
+            limits.append(day_limits)
+
+    return Schedule(tz, valid_from, offsets, limits)
+
+
+def truncate_timeline(cur, at):
+    # Everything before a write is history, so only the intervals after it
+    # need to be resolved again
+    cur.execute(
+        """
+            DELETE FROM limit_timeline
+            WHERE start >= :at;
+        """,
+        {'at': at}
+    )
+    cur.execute(
+        """
+            UPDATE limit_timeline
+            SET end = :at
+            WHERE end > :at;
+        """,
+        {'at': at}
+    )
+    cur.execute(
+        """
+            UPDATE limit_timeline_state
+            SET materialized_to = min(materialized_to, :at);
+        """,
+        {'at': at}
+    )
+
+
+class ScheduleResolver():
+    # Keeps the compiled schedule until data_versions shows that the presets
+    # or the active preset have changed
+    def __init__(self, tz):
+        self.tz = tz
+        self.versions = None
+        self.schedule = None
+        self.lock = threading.Lock()
+
+    def get_schedule(self, cur):
+        cur.execute("SELECT name, version FROM data_versions ORDER BY name ASC;")
+        versions = tuple((row['name'], row['version']) for row in cur.fetchall())
+
+        with self.lock:
+            if versions != self.versions:
+                self.schedule = compile_schedule(cur, self.tz)
+                self.versions = versions
+            return self.schedule
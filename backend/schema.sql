@@ -1,3 +1,6 @@
+-- Migrations in migrations/ are applied on top of this schema by init-db
+PRAGMA user_version = 0;
+
 DROP TABLE IF EXISTS preset_ids;
 DROP TABLE IF EXISTS preset_names;
 DROP TABLE IF EXISTS atomic_presets;
@@ -5,18 +8,37 @@ DROP TABLE IF EXISTS day_preset_chunks;
 DROP TABLE IF EXISTS week_presets;
 DROP TABLE IF EXISTS preset_history;
 DROP TABLE IF EXISTS temperatures;
+-- Created by migrations
+DROP TABLE IF EXISTS temperatures_5m;
+DROP TABLE IF EXISTS temperatures_1h;
+DROP TABLE IF EXISTS limit_timeline;
+DROP TABLE IF EXISTS limit_timeline_state;
+DROP TABLE IF EXISTS data_versions;
+DROP TABLE IF EXISTS relay_state;
+DROP TABLE IF EXISTS controller_ticks;
 
 DROP INDEX IF EXISTS current_preset_names;
 DROP INDEX IF EXISTS current_atomic_presets;
 DROP INDEX IF EXISTS current_day_preset_chunks;
 DROP INDEX IF EXISTS current_week_presets;
 DROP INDEX IF EXISTS active_preset;
+-- Created by migrations
+DROP INDEX IF EXISTS preset_history_validity;
 
 DROP TRIGGER IF EXISTS insert_preset_names;
 DROP TRIGGER IF EXISTS insert_atomic_presets;
 DROP TRIGGER IF EXISTS insert_day_preset_chunks;
 DROP TRIGGER IF EXISTS insert_week_presets;
 DROP TRIGGER IF EXISTS insert_preset_history;
+-- Created by migrations
+DROP TRIGGER IF EXISTS rollup_temperatures;
+DROP TRIGGER IF EXISTS version_preset_names;
+DROP TRIGGER IF EXISTS version_atomic_presets;
+DROP TRIGGER IF EXISTS version_day_preset_chunks;
+DROP TRIGGER IF EXISTS version_week_presets;
+DROP TRIGGER IF EXISTS version_insert_preset_history;
+DROP TRIGGER IF EXISTS version_update_preset_history;
+DROP TRIGGER IF EXISTS update_preset_ids;
 
 
 
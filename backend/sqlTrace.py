@@ -0,0 +1,151 @@
+import sqlite3
+import time
+import weakref
+
+# Optional instrumentation for the backend's connections. When enabled the
+# connection is opened with TracedConnection, whose cursors time every
+# statement including fetching its rows. Each connection carries a
+# RequestTrace counting its statements, and statements slower than the
+# threshold are logged, with their query plan if asked for
+
+
+class SqlTracer():
+    def __init__(self, logger, slow_ms=100, explain=False):
+        self.logger = logger
+        # Statements taking longer than this are logged
+        self.slow_ms = slow_ms
+        # Also log EXPLAIN QUERY PLAN for slow statements
+        self.explain = explain
+
+    @staticmethod
+    def from_env(env, logger):
+        if env.get('SQL_TRACE', '0') != '1':
+            return None
+        return SqlTracer(
+            logger,
+            slow_ms=float(env.get('SQL_SLOW_MS', 100)),
+            explain=env.get('SQL_EXPLAIN', '0') == '1'
+        )
+
+
+class RequestTrace():
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.statements = 0
+        self.elapsed = 0.0
+        self.slow = 0
+        self.cursors = weakref.WeakSet()
+
+    def finish(self):
+        # Cursors which were never closed still hold their last statement
+        for cursor in list(self.cursors):
+            cursor.finish_statement()
+
+    def record(self, con, sql, parameters, elapsed):
+        if elapsed * 1000 < self.tracer.slow_ms:
+            return
+        self.slow += 1
+        if parameters is None:
+            parameters = "many parameter sets"
+        self.tracer.logger.warning(
+            f"Slow statement took {elapsed * 1000:.1f}ms: {' '.join(sql.split())} with {parameters}"
+        )
+        # Statements run with executemany can't be explained with one set
+        if self.tracer.explain and not isinstance(parameters, str):
+            self.tracer.logger.warning("Query plan:\n" + self.explain(con, sql, parameters))
+
+    @staticmethod
+    def explain(con, sql, parameters):
+        cur = sqlite3.Cursor(con)
+        try:
+            cur.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            # Each row is (id, parent, notused, detail), indented by its depth
+            depth = {0: -1}
+            lines = []
+            for row in cur.fetchall():
+                depth[row[0]] = depth.get(row[1], -1) + 1
+                lines.append(("  " * depth[row[0]]) + row[3])
+            return "\n".join(lines)
+        except sqlite3.Error as e:
+            return f"Could not explain statement: {e}"
+        finally:
+            cur.close()
+
+
+class TracedCursor(sqlite3.Cursor):
+    def __init__(self, con):
+        super().__init__(con)
+        self.trace = con.trace
+        self.statement = None
+        self.trace.cursors.add(self)
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.trace.elapsed += elapsed
+            if self.statement is not None:
+                self.statement[2] += elapsed
+
+    def _start_statement(self, sql, parameters):
+        self.finish_statement()
+        self.trace.statements += 1
+        self.statement = [sql, parameters, 0.0]
+
+    def finish_statement(self):
+        if self.statement is not None:
+            sql, parameters, elapsed = self.statement
+            self.statement = None
+            self.trace.record(self.connection, sql, parameters, elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._start_statement(sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start_statement(sql, None)
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        # Scripts can't be explained, so are only counted
+        self.finish_statement()
+        self.trace.statements += 1
+        return self._timed(super().executescript, sql_script)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
@@ -0,0 +1,216 @@
+import random
+from itertools import islice
+from scheduleResolver import truncate_timeline
+
+# Shared by the backend's populate-db command and the benchmarks, so this
+# only needs a plain sqlite3 connection. Everything is generated lazily and
+# written in chunks, so any length of history runs in constant memory
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+class DatasetSpec():
+    def __init__(self, days=7, atomic_presets=0, day_presets=0, week_presets=0, versions=1, activation_hours=0, chunk_size=7 * 24 * 60, seed=None):
+        # Days of readings, ending at the end passed to generate_dataset
+        self.days = days
+        # Number of presets of each type, all created at the start
+        self.atomic_presets = atomic_presets
+        self.day_presets = day_presets
+        self.week_presets = week_presets
+        # Versions of each preset, with the edits spread over the whole range
+        self.versions = versions
+        # Mean hours between activations, or 0 for no preset history
+        self.activation_hours = activation_hours
+        # Rows written per transaction
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def max_versions(days):
+    # Versions are spread at least two seconds apart, so that each one after
+    # the first has a random time strictly inside its own step
+    return (days * DAY) // 2
+
+
+def _version_times(rnd, spec, start, end):
+    # The first version is always at the start, so every preset exists
+    # before anything can activate it
+    step = (end - start) // spec.versions
+    return [start] + sorted(
+        start + (i * step) + rnd.randrange(1, step)
+        for i in range(1, spec.versions)
+    )
+
+
+def _insert_preset(cur, preset_type, name, valid_from):
+    cur.execute("INSERT INTO preset_ids (type) VALUES (?);", (preset_type,))
+    preset_id = cur.lastrowid
+    cur.execute(
+        "INSERT INTO preset_names (preset_id, name, valid_from) VALUES (?, ?, ?);",
+        (preset_id, name, valid_from)
+    )
+    return preset_id
+
+
+def _rename_preset(cur, preset_id, name, valid_from):
+    cur.execute(
+        "INSERT INTO preset_names (preset_id, name, valid_from) VALUES (?, ?, ?);",
+        (preset_id, name, valid_from)
+    )
+
+
+def _generate_atomic_preset(cur, rnd, spec, start, end, index):
+    preset_id = None
+    for version, valid_from in enumerate(_version_times(rnd, spec, start, end)):
+        if preset_id is None:
+            preset_id = _insert_preset(cur, 'atomic', f"Atomic {index}", valid_from)
+        else:
+            _rename_preset(cur, preset_id, f"Atomic {index} v{version + 1}", valid_from)
+
+        core_low = rnd.randint(300, 440)
+        oven_high = rnd.randint(150, core_low - 1)
+        cur.execute("""
+            INSERT INTO atomic_presets
+                (preset_id, core_high, core_low, oven_high, oven_low, valid_from)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, (preset_id, core_low + rnd.randint(10, 60), core_low, oven_high, oven_high - rnd.randint(10, 60), valid_from))
+    return preset_id
+
+
+def _generate_day_preset(cur, rnd, spec, start, end, index, atomics):
+    preset_id = None
+    for version, valid_from in enumerate(_version_times(rnd, spec, start, end)):
+        if preset_id is None:
+            preset_id = _insert_preset(cur, 'day', f"Day {index}", valid_from)
+        else:
+            _rename_preset(cur, preset_id, f"Day {index} v{version + 1}", valid_from)
+
+        # Half hour chunks, as the frontend offers, covering the whole day
+        cuts = sorted(rnd.sample(range(1, 48), rnd.randint(1, 8)))
+        for chunk_start, chunk_end in zip([0, *cuts], [*cuts, 48]):
+            cur.execute("""
+                INSERT INTO day_preset_chunks
+                    (preset_id, start, end, chunk_preset_id, valid_from)
+                VALUES (?, ?, ?, ?, ?);
+            """, (preset_id, chunk_start * 1800, chunk_end * 1800, rnd.choice(atomics), valid_from))
+    return preset_id
+
+
+def _generate_week_preset(cur, rnd, spec, start, end, index, presets):
+    preset_id = None
+    for version, valid_from in enumerate(_version_times(rnd, spec, start, end)):
+        if preset_id is None:
+            preset_id = _insert_preset(cur, 'week', f"Week {index}", valid_from)
+        else:
+            _rename_preset(cur, preset_id, f"Week {index} v{version + 1}", valid_from)
+
+        cur.execute("""
+            INSERT INTO week_presets
+                (preset_id, monday_preset_id, tuesday_preset_id, wednesday_preset_id, thursday_preset_id, friday_preset_id, saturday_preset_id, sunday_preset_id, valid_from)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, (preset_id, *[rnd.choice(presets) for _ in range(7)], valid_from))
+    return preset_id
+
+
+def _generate_presets(con, rnd, spec, start, end):
+    # Each preset and all of its versions is one transaction
+    cur = con.cursor()
+    atomics = []
+    for i in range(spec.atomic_presets):
+        atomics.append(_generate_atomic_preset(cur, rnd, spec, start, end, i + 1))
+        con.commit()
+
+    days = []
+    for i in range(spec.day_presets):
+        days.append(_generate_day_preset(cur, rnd, spec, start, end, i + 1, atomics))
+        con.commit()
+
+    weeks = []
+    for i in range(spec.week_presets):
+        weeks.append(_generate_week_preset(cur, rnd, spec, start, end, i + 1, atomics + days))
+        con.commit()
+
+    cur.close()
+    return atomics + days + weeks
+
+
+def _generate_activations(rnd, spec, presets, start, end):
+    # A preset is activated at the start, and then more arrive at random
+    # with the given mean gap, sometimes turning the oven off instead
+    active_from = start + 1
+    preset_id = rnd.choice(presets)
+    while active_from < end:
+        yield (preset_id, active_from)
+        active_from += max(1, round(rnd.expovariate(1 / (spec.activation_hours * HOUR))))
+        preset_id = 0 if rnd.random() < 0.1 else rnd.choice(presets)
+
+
+def _generate_temperatures(rnd, start, end):
+    # Random walk of the core, with the oven trailing it
+    core = 450
+    difference = 0
+    core_change = 0
+    difference_change = 0
+    for _time in range(start - (start % MINUTE), end + 1, MINUTE):
+        core = max(min(core + core_change, 500), 300)
+        difference = max(min(difference + difference_change, 100), -5)
+        core_change = max(min(core_change + rnd.randint(-1, 1), 10), -10)
+        difference_change = max(min(difference_change + rnd.randint(-1, 1), 10), -10)
+        yield (_time, core, core - difference, core_change > 0, core_change - difference_change > 0)
+
+
+def generate_dataset(con, spec, end):
+    if spec.versions > max_versions(spec.days):
+        raise ValueError(f"At most {max_versions(spec.days)} versions fit in {spec.days} days, got {spec.versions}")
+
+    rnd = random.Random(spec.seed)
+    start = end - (spec.days * DAY)
+    counts = {'presets': 0, 'activations': 0, 'readings': 0}
+
+    cur = con.cursor()
+    # So that the backdated history is resolved into the timeline when it
+    # is next read
+    truncate_timeline(cur, start)
+    con.commit()
+
+    presets = _generate_presets(con, rnd, spec, start, end)
+    counts['presets'] = len(presets)
+
+    if spec.activation_hours > 0 and len(presets) > 0:
+        # History can only be appended to, so start after anything already there
+        cur.execute("""
+            SELECT max(COALESCE(max(active_from), 0), COALESCE(max(active_to), 0))
+            FROM preset_history;
+        """)
+        activations_start = max(start, cur.fetchone()[0])
+        for chunk in _chunks(_generate_activations(rnd, spec, presets, activations_start, end), spec.chunk_size):
+            cur.executemany(
+                "INSERT INTO preset_history (preset_id, active_from) VALUES (?, ?);",
+                chunk
+            )
+            con.commit()
+            counts['activations'] += len(chunk)
+
+    for chunk in _chunks(_generate_temperatures(rnd, start, end), spec.chunk_size):
+        cur.executemany("""
+            INSERT INTO temperatures
+                (time, core, oven, core_on, oven_on)
+            VALUES
+                (?, ?, ?, ?, ?);
+        """, chunk)
+        con.commit()
+        counts['readings'] += len(chunk)
+
+    cur.close()
+    return counts
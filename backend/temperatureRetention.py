@@ -0,0 +1,158 @@
+import sqlite3
+import time
+
+# Shared by the backend's apply-retention command and the controller's
+# schedule, so this opens its own connection rather than using Flask's
+
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+
+class RetentionPolicy():
+    def __init__(self, raw_days=30, rollup_days=365, batch_size=1440, archive=None):
+        # Days of full resolution readings to keep
+        self.raw_days = raw_days
+        # Days of 5 minute rollups to keep, hourly rollups are kept forever
+        self.rollup_days = rollup_days
+        # Rows removed per transaction
+        self.batch_size = batch_size
+        # Database file that removed readings are moved to, or None to delete
+        self.archive = archive
+
+    @staticmethod
+    def from_env(env):
+        return RetentionPolicy(
+            raw_days=int(env.get('RETENTION_RAW_DAYS', 30)),
+            rollup_days=int(env.get('RETENTION_ROLLUP_DAYS', 365)),
+            batch_size=int(env.get('RETENTION_BATCH_SIZE', 1440)),
+            archive=env.get('RETENTION_ARCHIVE') or None
+        )
+
+
+def _connect(db_name, policy, busy_timeout):
+    # Transactions are managed explicitly so each batch is its own short
+    # write, and so the archive can be attached
+    con = sqlite3.connect(db_name, timeout=busy_timeout, isolation_level=None)
+    if policy.archive is not None:
+        con.execute("ATTACH DATABASE :archive AS archive;", {'archive': policy.archive})
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS archive.temperatures (
+                time INTEGER PRIMARY KEY,
+                core INTEGER NOT NULL,
+                oven INTEGER NOT NULL,
+                core_on BOOLEAN NOT NULL,
+                oven_on BOOLEAN NOT NULL
+            );
+        """)
+    return con
+
+
+def _rebuild_rollup(cur, table, bucket, batch_end):
+    # Makes sure the rollup holds every reading before it is removed,
+    # including any written before the rollup trigger existed
+    cur.execute(f"""
+        INSERT OR REPLACE INTO {table}
+            (time, samples, core_min, core_max, core_sum, oven_min, oven_max, oven_sum, core_on_count, oven_on_count)
+        SELECT
+            time - (time % :bucket),
+            count(*),
+            min(core),
+            max(core),
+            sum(core),
+            min(oven),
+            max(oven),
+            sum(oven),
+            sum(core_on),
+            sum(oven_on)
+        FROM temperatures
+        WHERE time < :batch_end
+        GROUP BY time - (time % :bucket);
+    """, {'bucket': bucket, 'batch_end': batch_end})
+
+
+def _remove_raw_batch(cur, policy, cutoff):
+    cur.execute("""
+        SELECT max(time) as time
+        FROM (
+            SELECT time
+            FROM temperatures
+            WHERE time < :cutoff
+            ORDER BY time ASC
+            LIMIT :batch_size
+        );
+    """, {'cutoff': cutoff, 'batch_size': policy.batch_size})
+    last = cur.fetchone()[0]
+    if last is None:
+        return 0
+
+    # Batches end on an hour so no rollup bucket is left half removed
+    batch_end = min(last - (last % HOUR) + HOUR, cutoff)
+
+    _rebuild_rollup(cur, 'temperatures_5m', 5 * 60, batch_end)
+    _rebuild_rollup(cur, 'temperatures_1h', HOUR, batch_end)
+
+    if policy.archive is not None:
+        cur.execute("""
+            INSERT OR IGNORE INTO archive.temperatures
+                (time, core, oven, core_on, oven_on)
+            SELECT time, core, oven, core_on, oven_on
+            FROM temperatures
+            WHERE time < :batch_end;
+        """, {'batch_end': batch_end})
+
+    cur.execute("DELETE FROM temperatures WHERE time < :batch_end;", {'batch_end': batch_end})
+    return cur.rowcount
+
+
+def _remove_rollup_batch(cur, policy, cutoff):
+    cur.execute("""
+        DELETE FROM temperatures_5m
+        WHERE time IN (
+            SELECT time
+            FROM temperatures_5m
+            WHERE time < :cutoff
+            ORDER BY time ASC
+            LIMIT :batch_size
+        );
+    """, {'cutoff': cutoff, 'batch_size': policy.batch_size})
+    return cur.rowcount
+
+
+def _run_batches(con, remove_batch, policy, cutoff, pause):
+    removed = 0
+    while True:
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE;")
+            count = remove_batch(cur, policy, cutoff)
+            cur.execute("COMMIT;")
+        except sqlite3.Error as e:
+            if con.in_transaction:
+                cur.execute("ROLLBACK;")
+            raise e
+        finally:
+            cur.close()
+
+        if count == 0:
+            return removed
+        removed += count
+        # Gives the controller a chance to take the write lock
+        time.sleep(pause)
+
+
+def apply_retention(db_name, policy, now=None, busy_timeout=10, pause=0.05):
+    if now is None:
+        now = int(time.time())
+
+    raw_cutoff = now - (policy.raw_days * DAY)
+    raw_cutoff -= raw_cutoff % HOUR
+    rollup_cutoff = now - (policy.rollup_days * DAY)
+
+    con = _connect(db_name, policy, busy_timeout)
+    try:
+        return {
+            'raw': _run_batches(con, _remove_raw_batch, policy, raw_cutoff, pause),
+            'rollup': _run_batches(con, _remove_rollup_batch, policy, rollup_cutoff, pause)
+        }
+    finally:
+        con.close()
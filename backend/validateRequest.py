@@ -17,12 +17,29 @@ def tautology(x: Any) -> bool:
     return True
 
 ValidationResult : TypeAlias = tuple[bool, str]
+Validator: TypeAlias = Callable[[Any], ValidationResult]
+
+VALID: ValidationResult = (True, "")
 
 
 class JsonSchema(ABC):
+    _compiled: Validator | None = None
+
     @abstractmethod
     def validate(self, json_node: Any) -> ValidationResult:
         pass
+
+    @abstractmethod
+    def _compile(self) -> Validator:
+        pass
+
+    def compile(self) -> Validator:
+        # Flattens the schema into closures that give the same results as
+        # validate without walking the schema tree for every node.
+        # Schemas shared between parents are only compiled once
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
         
 
 class ConstraintSchema(JsonSchema):
@@ -58,6 +75,39 @@ class ConstraintSchema(JsonSchema):
             return False, self.error_message.format(**context)
         return valid, error_message
 
+    def _compile(self) -> Validator:
+        child = self.child
+        optional = self.optional
+        filter_fn = self.filter_fn
+        error_message = self.error_message
+
+        def fail(json: Any) -> ValidationResult:
+            if error_message == None:
+                return False, f"Got value: {json} which did not pass filter_fn"
+            return False, error_message.format(json=json)
+
+        if not isinstance(child, JsonSchema):
+            # Atomic children are checked inline as they make up most nodes
+            def validate_atomic(json: Any) -> ValidationResult:
+                if optional and json is None:
+                    return VALID
+                if type(json) != child:
+                    return False, f"Expected type {child}, got type {type(json)}"
+                if not filter_fn(json):
+                    return fail(json)
+                return VALID
+            return validate_atomic
+
+        validate_child = child.compile()
+        def validate_constraint(json: Any) -> ValidationResult:
+            if optional and json is None:
+                return VALID
+            result = validate_child(json)
+            if result[0] and not filter_fn(json):
+                return fail(json)
+            return result
+        return validate_constraint
+
 
 class ListSchema(JsonSchema):
     # Used to represent a JSON array
@@ -76,6 +126,19 @@ class ListSchema(JsonSchema):
                 return False, error_message
         return True, ""
 
+    def _compile(self) -> Validator:
+        validate_child = compile_schema(self.child)
+
+        def validate_list(json: Any) -> ValidationResult:
+            if type(json) != list:
+                return False, f"Received type: {type(json)}, expected type: list"
+            for element in json:
+                result = validate_child(element)
+                if not result[0]:
+                    return result
+            return VALID
+        return validate_list
+
 
 class DictSchema(JsonSchema):
     # Used to represent a JSON object
@@ -97,22 +160,57 @@ class DictSchema(JsonSchema):
                 return False, error
         return True, ""
 
+    def _compile(self) -> Validator:
+        validators = [(key, compile_schema(schema)) for key, schema in self.schema.items()]
+
+        def validate_dict(json_dict: Any) -> ValidationResult:
+            if type(json_dict) != dict:
+                return False, f"Received type: {type(json_dict)} {json_dict}, expected type: dict"
+            for key, validate_value in validators:
+                json = json_dict.get(key)
+                result = validate_value(json)
+                if not result[0]:
+                    if json == None:
+                        return False, f"Received: {json_dict}, expected key: {key}"
+                    return result
+            return VALID
+        return validate_dict
+
 
 def compare_json_types(schema: ConstrainedJson, json: Any) -> ValidationResult:  
     if isinstance(schema, JsonSchema):
         return schema.validate(json)
     elif type(json) == schema:
         return True, ""
-    print(json, type(json), type(schema), schema)
     return False, f"Expected type {schema}, got type {type(json)}"
 
 
+def compile_schema(schema: ConstrainedJson) -> Validator:
+    if isinstance(schema, JsonSchema):
+        return schema.compile()
+
+    def validate_type(json: Any) -> ValidationResult:
+        if type(json) == schema:
+            return VALID
+        return False, f"Expected type {schema}, got type {type(json)}"
+    return validate_type
+
+
+def compile_schemas(*namespaces: type) -> None:
+    # Compiles every schema defined on the given classes up front, so that
+    # requests never pay for it
+    for namespace in namespaces:
+        for schema in vars(namespace).values():
+            if isinstance(schema, JsonSchema):
+                schema.compile()
+
+
 def validate_json_request(schema: ConstrainedJson, 
                           request: Request) -> tuple[Json | None, str]:
     if not request.is_json:
         return None, "Expected JSON"
     json = request.get_json()
-    valid, error_message = compare_json_types(schema, request.get_json())
+    valid, error_message = compile_schema(schema)(json)
     if not valid:
         return None, error_message
     return json, error_message
@@ -122,12 +220,7 @@ def expected_keys(schema: 'DictSchema') -> None:
     # Check for keys in the input which don't appear in the schema
     # Missing keys will be caught later
     def check_keys_expected(json_dict: dict):
-        json_keys = json_dict.keys()
-        schema_keys = schema.schema.keys()
-        for key in json_keys:
-            if key not in schema_keys:
-                return False
-        return True
+        return json_dict.keys() <= schema.schema.keys()
     
     return ConstraintSchema(
         schema,
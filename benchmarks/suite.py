@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BACKEND = os.path.join(ROOT, 'backend')
+SCRIPTS = os.path.join(ROOT, 'scripts')
+
+# The controller imports the shared modules from the backend
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, SCRIPTS)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scheduleResolver import truncate_timeline
+from syntheticData import DatasetSpec, generate_dataset
+
+# Times each hot path of the backend and controller against a temporary
+# database seeded with a year of readings, at several history sizes.
+# Results can be saved with --output and compared with --compare
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+YEAR = 365 * DAY
+
+SIZES = {
+    'hour': HOUR,
+    'day': DAY,
+    'week': WEEK,
+    'year': YEAR
+}
+
+# Fixed so that runs on different commits see the same data, and chosen to
+# leave a DST change inside every size above a day
+NOW = 1790000000
+
+
+def seed(db_name, span, seed=0):
+    con = sqlite3.connect(db_name)
+    with open(os.path.join(BACKEND, 'schema.sql')) as f:
+        con.executescript(f.read())
+    migrations = sorted(
+        name for name in os.listdir(os.path.join(BACKEND, 'migrations'))
+        if name.endswith('.sql')
+    )
+    for name in migrations:
+        with open(os.path.join(BACKEND, 'migrations', name)) as f:
+            con.executescript(f.read())
+        con.execute(f"PRAGMA user_version = {int(name.split('_', 1)[0])};")
+
+    # A handful of presets edited every few weeks, and activated every
+    # couple of days
+    spec = DatasetSpec(
+        days=(span // DAY) + 1,
+        atomic_presets=6,
+        day_presets=4,
+        week_presets=2,
+        versions=max(1, span // (3 * WEEK)),
+        activation_hours=48,
+        seed=seed
+    )
+    generate_dataset(con, spec, NOW)
+    con.close()
+
+
+def measure(func, repeat, setup=None):
+    # One untimed call first, so caches and the timeline are warm. setup runs
+    # untimed before every call
+    if setup is not None:
+        setup()
+    func()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def run(db_name, sizes, repeat):
+    os.environ['DB_NAME'] = db_name
+    from databaseManager import DatabaseManager, PresetManager
+    from requestSchemas import RequestSchemas
+    from validateRequest import compare_json_types, compile_schema
+    from validation import make_day_preset
+    import app
+    import controller
+
+    DatabaseManager.db_name = db_name
+    truncate = DatabaseManager.execute_db(truncate_timeline)
+    results = {}
+
+    with app.app.app_context():
+        for size in sizes:
+            start = NOW - SIZES[size]
+            results[f"get_boxes/{size}"] = measure(
+                lambda: PresetManager.get_boxes(start, NOW), repeat)
+            # Truncated before every call, so the limits are resolved from the
+            # presets each time rather than read from the timeline
+            results[f"get_boxes_cold/{size}"] = measure(
+                lambda: PresetManager.get_boxes(start, NOW), repeat,
+                setup=lambda: truncate(start))
+            results[f"get_temperatures/{size}"] = measure(
+                lambda: PresetManager.get_temperatures(start, NOW), repeat)
+            results[f"get_history/{size}"] = measure(
+                lambda: PresetManager.get_history(start, NOW), repeat)
+
+    # A day preset in the half hour chunks the frontend offers
+    schema = RequestSchemas.dayPreset.edit
+    preset = make_day_preset(48)
+    validate = compile_schema(schema)
+    results["compare_json_types/day_preset"] = measure(
+        lambda: compare_json_types(schema, preset), repeat)
+    results["validate_json/day_preset"] = measure(
+        lambda: validate(preset), repeat)
+
+    handler = controller.DatabaseHandler()
+    handler.init_resources()
+    cur = handler.con.cursor()
+    results["get_limits/tick"] = measure(
+        lambda: handler.get_limits(cur, NOW), repeat)
+    handler.handle_cleanup()
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    header = f"{'benchmark':<36} {'min':>12} {'median':>12}"
+    if baseline is not None:
+        header += f" {'vs base':>9}"
+    print(header)
+
+    for name, result in results.items():
+        line = f"{name:<36} {result['min'] * 1e3:>10.3f}ms {result['median'] * 1e3:>10.3f}ms"
+        if baseline is not None and name in baseline:
+            line += f" {result['median'] / baseline[name]['median']:>8.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend and controller hot paths")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES),
+                        help="History sizes to time")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed calls per benchmark")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the generated data")
+    parser.add_argument('--db', help="Database file to use instead of a temporary one, seeded if missing")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    span = max(SIZES[size] for size in args.sizes)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = args.db or os.path.join(directory, 'benchmark.db')
+        if not os.path.exists(db_name):
+            started = time.perf_counter()
+            seed(db_name, span, args.seed)
+            print(f"Seeded {db_name} in {time.perf_counter() - started:.1f}s")
+
+        results = run(db_name, args.sizes, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': get_commit(), 'repeat': args.repeat, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from requestSchemas import RequestSchemas
+from validateRequest import compare_json_types, compile_schema
+
+# Compares the schema interpreter with the compiled validators on day
+# presets with increasing numbers of chunks
+
+# A day preset can't have more than a chunk per minute
+SIZES = [10, 100, 1000, 1440]
+REPEATS = 5
+
+
+def make_day_preset(chunks):
+    # Spread over the day, as times must be strictly increasing
+    step = 1440 // chunks
+    times = [
+        {'hour': (i * step) // 60, 'minute': (i * step) % 60}
+        for i in range(1, chunks)
+    ]
+    return {
+        'id': 1,
+        'name': f"Day preset with {chunks} chunks",
+        'preset': [i % 8 for i in range(chunks)],
+        'time': times
+    }
+
+
+def best_time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=REPEATS)) / number
+
+
+def main():
+    schema = RequestSchemas.dayPreset.edit
+    validate = compile_schema(schema)
+
+    print(f"{'chunks':>8} {'interpreted':>14} {'compiled':>14} {'speedup':>8}")
+    for size in SIZES:
+        preset = make_day_preset(size)
+        assert compare_json_types(schema, preset) == validate(preset) == (True, "")
+
+        number = max(1, 10000 // size)
+        interpreted = best_time(lambda: compare_json_types(schema, preset), number)
+        compiled = best_time(lambda: validate(preset), number)
+        print(f"{size:>8} {interpreted * 1e6:>12.1f}us {compiled * 1e6:>12.1f}us {interpreted / compiled:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
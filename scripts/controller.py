@@ -1,12 +1,16 @@
 import sqlite3
 import time
-from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import schedule
 import logging
 import atexit
 import sys
 import signal
+from scheduleResolver import ScheduleResolver
+from temperatureRetention import RetentionPolicy, apply_retention
+import threading
+import os
+from collections import deque
 try:
     import RPi.GPIO as GPIO
     ON_PI = True
@@ -16,132 +20,65 @@ except (ImportError, RuntimeError):
 tz = ZoneInfo("Europe/London")
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+DB_NAME = os.environ.get('DB_NAME', "/app/data/temperatures_and_presets.db")
+
 class DatabaseHandler():
+    # Seconds sqlite waits on a lock held by the backend before giving up
+    busy_timeout = 10
+    # Times a tick's transaction is retried if it still couldn't get the lock
+    lock_retries = 3
+    lock_backoff = 0.5
+
     def __init__(self):
         self.con = None
+        self.resolver = ScheduleResolver(tz)
+        self.lock_waits = 0
     
     def init_resources(self):
         try:
             self.con = sqlite3.connect(
-                "/app/data/temperatures_and_presets.db",
-                detect_types=sqlite3.PARSE_DECLTYPES
+                DB_NAME,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                timeout=self.busy_timeout
             )
             self.con.row_factory = sqlite3.Row
+            self.con.execute("PRAGMA journal_mode=WAL;")
+            self.con.execute("PRAGMA synchronous=NORMAL;")
         except sqlite3.Error as e:
             logging.error(f"Database connection failed: {e}")
             sys.exit(1) # Exit the script with a failure code
+
+    @staticmethod
+    def is_locked(e):
+        return (
+            isinstance(e, sqlite3.OperationalError)
+            and (e.sqlite_errorcode & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+        )
+
+    def run_transaction(self, func, *args):
+        for attempt in range(self.lock_retries + 1):
+            try:
+                with self.con:
+                    cur = self.con.cursor()
+                    return func(cur, *args)
+            except sqlite3.Error as e:
+                if not self.is_locked(e) or attempt == self.lock_retries:
+                    raise e
+                self.lock_waits += 1
+                logging.warning(f"Database locked, retrying transaction ({self.lock_waits} lock waits)")
+                time.sleep(self.lock_backoff * (2 ** attempt))
     
     def handle_cleanup(self):
         if self.con:
             self.con.close()
 
     def get_limits(self, cur, _time):
-        extract_active = """
-            SELECT preset_id
-            FROM preset_history
-            WHERE active_to IS NULL;
-        """
+        limits = self.resolver.get_schedule(cur).at(_time)
 
-        cur.execute(extract_active)
-        active = cur.fetchone()
-
-        if active is None:
+        if limits is None:
             return {'preset_id': 0}
-        
-        preset_id = active['preset_id']
 
-        extract_week_preset = """
-            SELECT 
-                preset_id, 
-                monday_preset_id, 
-                tuesday_preset_id, 
-                wednesday_preset_id, 
-                thursday_preset_id, 
-                friday_preset_id, 
-                saturday_preset_id, 
-                sunday_preset_id
-            FROM week_presets
-            WHERE 
-                preset_id = :preset_id
-                AND valid_from <= :time
-                AND (
-                    valid_to IS NULL 
-                    OR valid_to > :time
-                );
-        """
-
-        cur.execute(
-            extract_week_preset, 
-            {'preset_id': preset_id, 'time': _time}
-        )
-        week_preset = cur.fetchone()
-
-        if week_preset is not None:
-            day_id_keys = ['monday_preset_id', 'tuesday_preset_id', 'wednesday_preset_id', 'thursday_preset_id', 'friday_preset_id', 'saturday_preset_id', 'sunday_preset_id']
-            day = datetime.fromtimestamp(_time, tz=tz).weekday()
-            preset_id = week_preset[day_id_keys[day]]
-
-        extract_day_presets = """
-            SELECT 
-                preset_id, 
-                start, 
-                end, 
-                chunk_preset_id
-            FROM day_preset_chunks
-            WHERE 
-                preset_id = :preset_id
-                AND valid_from <= :time
-                AND (
-                    valid_to IS NULL 
-                    OR valid_to > :time
-                );
-        """
-
-        cur.execute(
-            extract_day_presets, 
-            {'preset_id': preset_id, 'time': _time}
-        )
-        day_presets = cur.fetchall()
-
-        if len(day_presets) > 0:
-            time_dt = datetime.fromtimestamp(_time, tz=tz)
-            day_start = time_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-            for chunk in day_presets:
-                if (
-                    day_start + timedelta(seconds=chunk['start']) <= time_dt
-                    and day_start + timedelta(seconds=chunk['end']) > time_dt
-                ):
-                    preset_id = chunk['chunk_preset_id']
-                    break
-
-        extract_atomic_preset = """
-            SELECT 
-                preset_id,
-                core_high,
-                core_low,
-                oven_high, 
-                oven_low
-            FROM atomic_presets
-            WHERE 
-                preset_id = :preset_id
-                AND valid_from <= :time
-                AND (
-                    valid_to IS NULL 
-                    OR valid_to > :time
-                );
-        """
-
-        cur.execute(
-            extract_atomic_preset, 
-            {'preset_id': preset_id, 'time': _time}
-        )
-        atomic_preset = cur.fetchone()
-
-        if atomic_preset is None:
-            logging.error(f"Limits read failed")
-            return {}
-
-        return dict(atomic_preset)
+        return dict(limits)
 
     def get_previous(self, cur):
         extract_previous = """
@@ -166,15 +103,48 @@ class DatabaseHandler():
         }
     
     def insert_record(self, cur, record):
+        # A minute already recorded, such as after the clock steps back, is
+        # kept as it is. Failing would leave the minute pending, so every
+        # later tick would fail on it too
         insert = """
             INSERT INTO temperatures
                 (time, core, oven, core_on, oven_on)
             VALUES
                 (:time, :core, :oven, :core_on, :oven_on)
+            ON CONFLICT (time) DO NOTHING
         """
 
         cur.execute(insert, record)
 
+    def update_relay_state(self, cur, sample):
+        update = """
+            INSERT INTO relay_state
+                (id, time, core_on, oven_on)
+            VALUES
+                (0, :time, :core_on, :oven_on)
+            ON CONFLICT (id) DO UPDATE SET
+                time = excluded.time,
+                core_on = excluded.core_on,
+                oven_on = excluded.oven_on
+        """
+
+        cur.execute(update, sample)
+
+    def insert_ticks(self, cur, ticks, interval):
+        insert = """
+            INSERT OR REPLACE INTO controller_ticks
+                (slot, time, drift_ms, duration_ms, sensor_ms, db_ms, relay_ms, lock_waits, relay_toggles, ok)
+            VALUES
+                (:slot, :time, :drift_ms, :duration_ms, :sensor_ms, :db_ms, :relay_ms, :lock_waits, :relay_toggles, :ok)
+        """
+
+        # A day of ticks, after which each slot is overwritten
+        slots = 24 * 60 * 60 // interval
+        cur.executemany(insert, [
+            {**tick, 'slot': (tick['time'] // interval) % slots}
+            for tick in ticks
+        ])
+
 
 
 class GpioHandler():
@@ -215,6 +185,22 @@ class Controller():
         self.set_cleanup_handler(self.handle_cleanup)
         self.db.init_resources()
 
+        # Seconds between readings, relays are switched after every reading
+        # but only one aggregated record is written each minute
+        self.sample_interval = int(os.environ.get('SAMPLE_INTERVAL', 60))
+        if self.sample_interval < 1 or 60 % self.sample_interval != 0:
+            logging.error(f"SAMPLE_INTERVAL must divide 60, got {self.sample_interval}")
+            sys.exit(1)
+
+        self.samples = deque(maxlen=60 // self.sample_interval)
+        # Samples before this time have been written to the database
+        self.written_to = 0
+        self.previous = None
+
+        # Timings of ticks not yet written, each tick's are written by the
+        # next successful transaction so recording them costs no extra writes
+        self.ticks = deque(maxlen=60)
+
     def handle_cleanup(self, signum=None, frame=None):
         self.db.handle_cleanup()
         self.gpio.handle_cleanup()
@@ -236,38 +222,143 @@ class Controller():
             return True
         return previous[f"{sector}_on"]
 
-    def run_task(self):
-        try:
-            _time = int(time.time())
+    @staticmethod
+    def aggregate(minute_start, samples):
+        count = len(samples)
+        return {
+            'time': minute_start,
+            'core': round(sum(s['core'] for s in samples) / count),
+            'oven': round(sum(s['oven'] for s in samples) / count),
+            'core_on': sum(s['core_on'] for s in samples) * 2 >= count,
+            'oven_on': sum(s['oven_on'] for s in samples) * 2 >= count
+        }
 
-            temps = self.gpio.get_temperatures()
+    def record_sample(self, cur, _time, temps):
+        # Must not change any state, as it is retried if the database is locked
+        if len(self.ticks) > 0:
+            self.db.insert_ticks(cur, self.ticks, self.sample_interval)
 
-            con = self.db.con
-            with con:
-                cur = con.cursor()
-                limits = self.db.get_limits(cur, _time)
-                previous = self.db.get_previous(cur)
-                    
-                record = {
-                    'time': _time,
-                    'core': temps.get('core', 0),
-                    'oven': temps.get('oven', 0),
-                    'core_on': self.should_be_on('core', temps, limits, previous),
-                    'oven_on': self.should_be_on('oven', temps, limits, previous),
-                }
+        limits = self.db.get_limits(cur, _time)
+        previous = self.previous
+        if previous is None:
+            previous = self.db.get_previous(cur)
+            
+        sample = {
+            'time': _time,
+            'core': temps.get('core', 0),
+            'oven': temps.get('oven', 0),
+            'core_on': self.should_be_on('core', temps, limits, previous),
+            'oven_on': self.should_be_on('oven', temps, limits, previous),
+        }
 
-                self.db.insert_record(cur, record)
+        if (
+            self.previous is None
+            or sample['core_on'] != self.previous['core_on']
+            or sample['oven_on'] != self.previous['oven_on']
+        ):
+            self.db.update_relay_state(cur, sample)
+
+        minute_start = _time - (_time % 60)
+        minute_complete = (_time % 60) + self.sample_interval >= 60
+
+        pending = [s for s in self.samples if s['time'] >= self.written_to]
+        if minute_complete:
+            pending.append(sample)
+
+        # Includes earlier minutes whose last sample was missed
+        minutes = {}
+        for s in pending:
+            start = s['time'] - (s['time'] % 60)
+            if start < minute_start or minute_complete:
+                minutes.setdefault(start, []).append(s)
+
+        for start, samples in sorted(minutes.items()):
+            self.db.insert_record(cur, self.aggregate(start, samples))
+
+        written_to = self.written_to
+        if minute_complete:
+            written_to = minute_start + 60
+        elif len(minutes) > 0:
+            written_to = minute_start
+
+        return sample, written_to
+
+    def run_task(self, scheduled=None):
+        # scheduled is the slot the scheduler fired for, which can be more
+        # than one interval ago if an earlier tick overran
+        started = time.time()
+        _time = int(started)
+        if scheduled is None:
+            scheduled = _time - (_time % self.sample_interval)
+        lock_waits = self.db.lock_waits
+        tick = {
+            'time': scheduled,
+            'drift_ms': (started - scheduled) * 1000,
+            'sensor_ms': 0,
+            'db_ms': 0,
+            'relay_ms': 0,
+            'relay_toggles': 0,
+            'ok': True
+        }
 
-            self.gpio.set_relays(record['core_on'], record['oven_on'])
+        try:
+            phase = time.perf_counter()
+            temps = self.gpio.get_temperatures()
+            tick['sensor_ms'] = (time.perf_counter() - phase) * 1000
+
+            phase = time.perf_counter()
+            sample, self.written_to = self.db.run_transaction(self.record_sample, _time, temps)
+            tick['db_ms'] = (time.perf_counter() - phase) * 1000
+            self.ticks.clear()
+
+            if self.previous is not None:
+                tick['relay_toggles'] = (
+                    int(sample['core_on'] != self.previous['core_on'])
+                    + int(sample['oven_on'] != self.previous['oven_on'])
+                )
+            self.samples.append(sample)
+            self.previous = {
+                'core_on': sample['core_on'],
+                'oven_on': sample['oven_on']
+            }
+
+            phase = time.perf_counter()
+            self.gpio.set_relays(sample['core_on'], sample['oven_on'])
+            tick['relay_ms'] = (time.perf_counter() - phase) * 1000
 
         except Exception as e:
             logging.error(f"Error running task: {e}")
+            tick['ok'] = False
             self.gpio.set_relays(False, False)
 
+        tick['duration_ms'] = (time.time() - started) * 1000
+        tick['lock_waits'] = self.db.lock_waits - lock_waits
+        self.ticks.append(tick)
+
+    def run_retention(self):
+        try:
+            removed = apply_retention(
+                DB_NAME, 
+                RetentionPolicy.from_env(os.environ),
+                busy_timeout=self.db.busy_timeout
+            )
+            logging.info(f"Retention removed {removed['raw']} readings and {removed['rollup']} rollups")
+        except Exception as e:
+            logging.error(f"Error applying retention: {e}")
+
+    def start_retention(self):
+        # Runs on its own connection and thread so the minute tick isn't held up
+        threading.Thread(target=self.run_retention, daemon=True).start()
+
 def main():
     controller = Controller()
 
-    schedule.every().minute.at(":00").do(controller.run_task)
+    for second in range(0, 60, controller.sample_interval):
+        # A job's next_run is only moved on after it has run, so while it
+        # runs it is still the slot it fired for
+        job = schedule.every().minute.at(f":{second:02d}")
+        job.do(lambda job=job: controller.run_task(int(job.next_run.timestamp())))
+    schedule.every().day.at("03:30").do(controller.start_retention)
 
     while True:
         schedule.run_pending()